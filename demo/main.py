@@ -23,13 +23,14 @@ micropython.mem_info()
 
 from slim.slim_server import SlimServer
 from slim.fileserver_module import FileserverModule
+from event_loop import EventLoop
 
 poller = select.poll()
 
 slim_server = SlimServer(poller)
 slim_server.add_module(FileserverModule({"html": "text/html"}))
 
-while True:
-    for (s, event) in poller.ipoll(0):
-        slim_server.pump(s, event)
-    slim_server.pump_expire()
+loop = EventLoop(poller)
+loop.add_pump(slim_server.pump)
+loop.add_timer(slim_server.ms_until_expire, slim_server.pump_expire)
+loop.run()
@@ -0,0 +1,46 @@
+# Rather than spinning on `poller.ipoll(0)`, this event loop asks each of its timers how long
+# it can wait before one of them needs to be run and then blocks in `ipoll` for that long (or
+# until a socket event arrives). On the ESP32, blocking in `ipoll` yields to the RTOS, i.e.
+# it frees up the CPU for the WiFi stack, and on the UNIX port it lets the process sleep.
+class EventLoop:
+    def __init__(self, poller):
+        self._poller = poller
+        self._pumps = []
+        self._timers = []
+        self._running = False
+
+    # Add a function that will be called with every `(s, event)` pair returned by `ipoll`.
+    def add_pump(self, pump):
+        self._pumps.append(pump)
+
+    # Add a function, `run`, that should be called whenever `ms_until` returns 0. `ms_until`
+    # should return the number of milliseconds until `run` needs to be called next or None if
+    # there's currently no need to call it.
+    def add_timer(self, ms_until, run):
+        self._timers.append((ms_until, run))
+
+    def stop(self):
+        self._running = False
+
+    def run(self):
+        self._running = True
+        while self._running:
+            for (s, event) in self._poller.ipoll(self._timeout()):
+                for pump in self._pumps:
+                    pump(s, event)
+            self._run_due()
+
+    # Returns the number of milliseconds until something needs to be run, or -1 (i.e. block
+    # until there's a socket event) if there's nothing to run.
+    def _timeout(self):
+        timeout = -1
+        for (ms_until, _) in self._timers:
+            ms = ms_until()
+            if ms is not None and (timeout < 0 or ms < timeout):
+                timeout = ms
+        return timeout
+
+    def _run_due(self):
+        for (ms_until, run) in self._timers:
+            if ms_until() == 0:
+                run()
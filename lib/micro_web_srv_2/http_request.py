@@ -17,74 +17,135 @@ class HttpRequest:
 
     # ------------------------------------------------------------------------
 
+    # A request, and the response and client that it owns, is reused for every request
+    # received on the client's connections. Each request is received by calling `start`.
     def __init__(self, config, xasCli, process_request):
+        self._config = config
         self._timeout_sec = config.timeout_sec
         self._xasCli = xasCli
         self._process_request = process_request
+        self._header_filter = None
+        self._request_num = 0
+        self._generation = 0
+
+        self._headers = {}
+        self._response = HttpResponse(config, self)
+        # Bound methods are allocated each time they're referenced so create this one once.
+        self._on_header_recv_cb = self._on_header_recv
+
+    # ------------------------------------------------------------------------
+
+    def start(self, header_filter=None, request_num=1):
+        self._header_filter = header_filter
+        self._request_num = request_num
+        self._generation += 1
 
         self._httpVer = ""
         self._method = ""
         self._path = ""
-        self._headers = {}
+        self._rawPath = ""
+        self._headers.clear()
         self._content = None
-        self._response = HttpResponse(config, self)
+        self._parsed = False
+        self._content_read = False
+        self._response._reset()
+
+        # A kept-alive connection, waiting for a subsequent request, is idle and has a separate timeout.
+        idle = request_num > 1
+        timeout_sec = self._config.keep_alive_timeout_sec if idle else self._timeout_sec
+        self._xasCli.async_recv_header_block(
+            onHeaderRecv=self._on_header_recv_cb, timeoutSec=timeout_sec, idle=idle
+        )
+
+    # ------------------------------------------------------------------------
 
-        self._recvLine(self._onFirstLineRecv)
+    # Returns true if the connection can be reused for another request once this one is complete.
+    def _keep_alive(self):
+        if not self._parsed or self._request_num >= self._config.max_requests:
+            return False
+        if self._httpVer != "HTTP/1.1":
+            return False
+        if "close" in self._headers.get("connection", "").lower():
+            return False
+        # Chunked content isn't supported, so it's never read.
+        if "transfer-encoding" in self._headers:
+            return False
+        # Otherwise unread content would be mistaken for the start of the next request.
+        return self._content_read or not self.ContentLength
 
     # ------------------------------------------------------------------------
 
-    def _recvLine(self, onRecv):
-        self._xasCli.AsyncRecvLine(onLineRecv=onRecv, timeoutSec=self._timeout_sec)
+    # Receive the next request on the same connection (and from any bytes already buffered).
+    def _next_request(self):
+        self.start(self._header_filter, self._request_num + 1)
 
     # ------------------------------------------------------------------------
 
-    def _onFirstLineRecv(self, xasCli, line, arg):
+    def _on_header_recv(self, xasCli, block, arg):
+        if block is None:
+            # The request line and headers don't fit in the receive buffer.
+            self._response.ReturnEntityTooLarge()
+            return
         try:
-            elements = line.strip().split()
-            if len(elements) == 3:
-                self._httpVer = elements[2].upper()
-                self._method = elements[0].upper()
-                elements = elements[1].split("?", 1)
-                self._path = UrlUtils.UnquotePlus(elements[0])
-                self._queryString = elements[1] if len(elements) > 1 else ""
-                self._queryParams = {}
-                if self._queryString:
-                    elements = self._queryString.split("&")
-                    for s in elements:
-                        p = s.split("=", 1)
-                        if len(p) > 0:
-                            v = UrlUtils.Unquote(p[1]) if len(p) > 1 else ""
-                            self._queryParams[UrlUtils.Unquote(p[0])] = v
-                self._recvLine(self._onHeaderLineRecv)
-            else:
+            # Use offsets into a single copy of the block rather than splitting it into lines.
+            data = bytes(block)
+            eol = data.find(b"\n")
+            if not self._parse_first_line(data[:eol].decode().strip()):
                 self._response.ReturnBadRequest()
+                return
+            names, lengths = self._header_filter or (None, None)
+            count = 0
+            pos = eol + 1
+            while pos < len(data):
+                eol = data.find(b"\n", pos)
+                colon = data.find(b":", pos, eol)
+                if colon < 0:
+                    self._response.ReturnBadRequest()
+                    return
+                if count == HttpRequest.MAX_RECV_HEADER_LINES:
+                    self._response.ReturnEntityTooLarge()
+                    return
+                count += 1
+                # Skip unwanted headers, most without allocating, based on name length.
+                if lengths is None or colon - pos in lengths:
+                    name = data[pos:colon].decode().strip().lower()
+                    if names is None or name in names:
+                        self._headers[name] = data[colon + 1 : eol].decode().strip()
+                pos = eol + 1
         except Exception as e:
             sys.print_exception(e)
             self._response.ReturnBadRequest()
+            return
+        self._parsed = True
+        self._process_request(self)
 
     # ------------------------------------------------------------------------
 
-    def _onHeaderLineRecv(self, xasCli, line, arg):
-        try:
-            elements = line.strip().split(":", 1)
-            if len(elements) == 2:
-                if len(self._headers) < HttpRequest.MAX_RECV_HEADER_LINES:
-                    self._headers[elements[0].strip().lower()] = elements[1].strip()
-                    self._recvLine(self._onHeaderLineRecv)
-                else:
-                    self._response.ReturnEntityTooLarge()
-            elif len(elements) == 1 and len(elements[0]) == 0:
-                self._process_request(self)
-            else:
-                self._response.ReturnBadRequest()
-        except Exception as e:
-            sys.print_exception(e)
-            self._response.ReturnBadRequest()
+    def _parse_first_line(self, line):
+        elements = line.split()
+        if len(elements) != 3:
+            return False
+        self._httpVer = elements[2].upper()
+        self._method = elements[0].upper()
+        elements = elements[1].split("?", 1)
+        self._rawPath = elements[0]
+        self._path = UrlUtils.UnquotePlus(elements[0])
+        self._queryString = elements[1] if len(elements) > 1 else ""
+        self._queryParams = {}
+        if self._queryString:
+            elements = self._queryString.split("&")
+            for s in elements:
+                p = s.split("=", 1)
+                if len(p) > 0:
+                    v = UrlUtils.Unquote(p[1]) if len(p) > 1 else ""
+                    self._queryParams[UrlUtils.Unquote(p[0])] = v
+        return True
 
     # ------------------------------------------------------------------------
 
     def async_data_recv(self, size, on_content_recv):
         def _on_content_recv(xasCli, content, arg):
+            self._content_read = True
             self._content = content
             on_content_recv()
             self._content = None
@@ -93,6 +154,39 @@ class HttpRequest:
             size=size, onDataRecv=_on_content_recv, timeoutSec=self._timeout_sec
         )
 
+    # Receive `size` bytes of content in pieces, no bigger than the receive slot, so that
+    # content of any size can be handled in constant memory. `on_chunk(chunk)` is called for
+    # each piece and the next piece isn't received until it returns, i.e. if it's slow then
+    # the client is made to wait. A chunk is only valid for the duration of the call. If
+    # `on_chunk` returns false, no more content is received. Otherwise `on_content_recv()` is
+    # called once all the content has been received.
+    def async_data_stream(self, size, on_chunk, on_content_recv):
+        slot_size = self._xasCli.RecvBufSlotSize
+        remaining = [size]
+
+        def _recv_next():
+            self._xasCli.AsyncRecvData(
+                size=min(remaining[0], slot_size),
+                onDataRecv=_on_chunk_recv,
+                timeoutSec=self._timeout_sec,
+            )
+
+        def _on_chunk_recv(xasCli, chunk, arg):
+            remaining[0] -= len(chunk)
+            if not on_chunk(chunk):
+                return
+            if remaining[0]:
+                _recv_next()
+            else:
+                self._content_read = True
+                on_content_recv()
+
+        if size:
+            _recv_next()
+        else:
+            self._content_read = True
+            on_content_recv()
+
     # ------------------------------------------------------------------------
 
     def GetPostedURLEncodedForm(self):
@@ -153,6 +247,14 @@ class HttpRequest:
 
     # ------------------------------------------------------------------------
 
+    # The path as it appeared in the request line, i.e. before percent-decoding, so that an
+    # encoded "/" can be told apart from a segment separator.
+    @property
+    def RawPath(self):
+        return self._rawPath
+
+    # ------------------------------------------------------------------------
+
     @property
     def QueryString(self):
         return self._queryString
@@ -234,6 +336,24 @@ class HttpRequest:
 
     # ------------------------------------------------------------------------
 
+    @property
+    def IfNoneMatch(self):
+        return self._headers.get("if-none-match", "")
+
+    # ------------------------------------------------------------------------
+
+    @property
+    def Range(self):
+        return self._headers.get("range", "")
+
+    # ------------------------------------------------------------------------
+
+    @property
+    def IfRange(self):
+        return self._headers.get("if-range", "")
+
+    # ------------------------------------------------------------------------
+
     @property
     def UserAgent(self):
         return self._headers.get("user-agent", "")
@@ -274,6 +394,15 @@ class HttpRequest:
     def XAsyncTCPClient(self):
         return self._xasCli
 
+    # ------------------------------------------------------------------------
+
+    # This object is reused for every request received on its client's connections. Something
+    # that responds later, e.g. once an operation completes, should check that `Generation`
+    # hasn't changed, i.e. that it's still the same request, before responding.
+    @property
+    def Generation(self):
+        return self._generation
+
 
 # ============================================================================
 # ============================================================================
@@ -76,11 +76,21 @@ class HttpResponse:
         self._not_found_url = config.not_found_url
         self._allow_all_origins = config.allow_all_origins
         self._server_name = config.server_name
+        self._keep_alive_timeout_sec = config.keep_alive_timeout_sec
 
         self._request = request
         self._xasCli = request.XAsyncTCPClient
 
         self._headers = {}
+        # Bound methods are allocated each time they're referenced so create this one once.
+        self._on_data_sent = self._onDataSent
+        self._reset()
+
+    # ------------------------------------------------------------------------
+
+    # Called, by the owning request, before each response.
+    def _reset(self):
+        self._headers.clear()
         self._allowCaching = False
         self._acAllowOrigin = None
         self._contentType = None
@@ -88,7 +98,9 @@ class HttpResponse:
         self._contentLength = 0
         self._stream = None
         self._sendingBuf = None
+        self._chunked = False
         self._hdrSent = False
+        self._keep_alive = False
 
         self._switch_result = None
 
@@ -103,53 +115,59 @@ class HttpResponse:
 
     # ------------------------------------------------------------------------
 
+    # Returns the number of bytes read into `buf` or None if the stream cannot be read.
+    def _read_stream(self, buf):
+        try:
+            n = self._stream.readinto(buf)
+            if n < len(buf):
+                self._stream.close()
+                self._stream = None
+            return n
+        except Exception as e:
+            sys.print_exception(e)
+            self._xasCli.Close()
+            _logger.error(
+                'stream cannot be read for request "%s".', self._request._path
+            )
+            return None
+
+    # ------------------------------------------------------------------------
+
     def _onDataSent(self, xasCli, arg):
         if self._stream:
-            try:
-                n = self._stream.readinto(self._sendingBuf)
-                if n < len(self._sendingBuf):
-                    self._stream.close()
-                    self._stream = None
-                    self._sendingBuf = self._sendingBuf[:n]
-            except Exception as e:
-                sys.print_exception(e)
-                self._xasCli.Close()
-                _logger.error(
-                    'stream cannot be read for request "%s".', self._request._path
-                )
+            n = self._read_stream(self._sendingBuf)
+            if n is None:
                 return
+            if not self._stream:
+                self._sendingBuf = self._sendingBuf[:n]
         if self._sendingBuf:
-            if self._contentLength:
+            size = len(self._sendingBuf)
+            if not self._stream:
+                self._sendingBuf = None
+            if not self._chunked:
                 self._xasCli.AsyncSendSendingBuffer(
-                    size=len(self._sendingBuf), onDataSent=self._onDataSent
+                    size=size, onDataSent=self._on_data_sent
                 )
-                if not self._stream:
-                    self._sendingBuf = None
             else:
-
-                def onChunkHdrSent(xasCli, arg):
-                    def onChunkDataSent(xasCli, arg):
-                        def onLastChunkSent(xasCli, arg):
-                            self._xasCli.AsyncSendData(
-                                b"0\r\n\r\n", onDataSent=self._onDataSent
-                            )
-
-                        if self._stream:
-                            onDataSent = self._onDataSent
-                        else:
-                            self._sendingBuf = None
-                            onDataSent = onLastChunkSent
-                        self._xasCli.AsyncSendData(b"\r\n", onDataSent=onDataSent)
-
-                    self._xasCli.AsyncSendSendingBuffer(
-                        size=len(self._sendingBuf), onDataSent=onChunkDataSent
-                    )
-
-                data = ("%x\r\n" % len(self._sendingBuf)).encode()
-                self._xasCli.AsyncSendData(data, onDataSent=onChunkHdrSent)
+                # Queue the chunk size, the chunk and the CRLF that ends it all at once.
+                self._xasCli.AsyncSendData(("%x\r\n" % size).encode())
+                self._xasCli.AsyncSendSendingBuffer(size=size)
+                if self._stream:
+                    self._xasCli.AsyncSendData(b"\r\n", onDataSent=self._on_data_sent)
+                else:
+                    self._send_last_chunk(b"\r\n")
+        elif self._sendingBuf is not None and self._chunked:
+            self._sendingBuf = None
+            self._send_last_chunk(b"")  # The stream ended exactly on a chunk boundary.
         else:
             self._xasCli.OnClosed = None
-            self._xasCli.Close()
+            if self._keep_alive:
+                self._request._next_request()
+            else:
+                self._xasCli.Close()
+
+    def _send_last_chunk(self, prefix):
+        self._xasCli.AsyncSendData(prefix + b"0\r\n\r\n", onDataSent=self._on_data_sent)
 
     # ------------------------------------------------------------------------
 
@@ -169,7 +187,8 @@ class HttpResponse:
 
     # ------------------------------------------------------------------------
 
-    def _makeBaseResponseHdr(self, code):
+    # `entity_headers`, if given, are preformatted headers, terminated by a blank line.
+    def _makeBaseResponseHdr(self, code, entity_headers=None):
         reason = self._reason(code)
         host = self._request.Host
         host = " to {}".format(host) if host else ""
@@ -188,16 +207,43 @@ class HttpResponse:
         if self._acAllowOrigin:
             self.SetHeader("Access-Control-Allow-Origin", self._acAllowOrigin)
         self.SetHeader("Server", self._server_name)
+        hdr = self._format_headers()
+        if entity_headers:
+            resp = "HTTP/1.1 %s %s\r\n%s" % (code, reason, hdr)
+            return resp.encode("ISO-8859-1") + entity_headers
+        resp = "HTTP/1.1 %s %s\r\n%s\r\n" % (code, reason, hdr)
+        return resp.encode("ISO-8859-1")
+
+    def _format_headers(self):
         hdr = ""
         for n in self._headers:
             hdr += "%s: %s\r\n" % (n, self._headers[n])
-        resp = "HTTP/1.1 %s %s\r\n%s\r\n" % (code, reason, hdr)
-        return resp.encode("ISO-8859-1")
+        return hdr
 
     # ------------------------------------------------------------------------
 
+    # Responses with these codes cannot include a body or a Content-Length header.
+    _NO_BODY_CODES = (204, 304)
+
     def _makeResponseHdr(self, code):
-        self.SetHeader("Connection", "Close")
+        self._set_connection_headers(code)
+        self._set_entity_headers()
+        return self._makeBaseResponseHdr(code)
+
+    def _set_connection_headers(self, code):
+        self._keep_alive = self._request._keep_alive()
+        if self._keep_alive:
+            self.SetHeader("Connection", "keep-alive")
+            self.SetHeader("Keep-Alive", "timeout=%s" % self._keep_alive_timeout_sec)
+            # The end of the response must be delimited by something other than closing the
+            # connection, i.e. it must specify a length or use chunked transfer-encoding.
+            if not self._contentLength and code not in self._NO_BODY_CODES:
+                if "Transfer-Encoding" not in self._headers:
+                    self.SetHeader("Content-Length", 0)
+        else:
+            self.SetHeader("Connection", "Close")
+
+    def _set_entity_headers(self):
         if self._allowCaching:
             self.SetHeader("Cache-Control", "public, max-age=31536000")
         else:
@@ -209,7 +255,6 @@ class HttpResponse:
             self.SetHeader("Content-Type", ct)
         if self._contentLength:
             self.SetHeader("Content-Length", self._contentLength)
-        return self._makeBaseResponseHdr(code)
 
     # ------------------------------------------------------------------------
 
@@ -237,7 +282,9 @@ class HttpResponse:
 
     # ------------------------------------------------------------------------
 
-    def ReturnStream(self, code, stream):
+    # If given, `entity_headers` are preformatted entity headers, as for `ReturnEntity`, and
+    # must include the Content-Length.
+    def ReturnStream(self, code, stream, entity_headers=None):
         if not isinstance(code, int) or code <= 0:
             raise ValueError('"code" must be a positive integer.')
         if not hasattr(stream, "readinto") or not hasattr(stream, "close"):
@@ -260,13 +307,38 @@ class HttpResponse:
                 stream.close()
             except Exception as e:
                 sys.print_exception(e)
-        if not self._contentType:
-            self._contentType = "application/octet-stream"
-        if not self._contentLength:
-            self.SetHeader("Transfer-Encoding", "chunked")
-        data = self._makeResponseHdr(code)
-        self._xasCli.AsyncSendData(data, onDataSent=self._onDataSent)
+        if entity_headers:
+            self._set_connection_headers(code)
+            data = self._makeBaseResponseHdr(code, entity_headers)
+        else:
+            if not self._contentType:
+                self._contentType = "application/octet-stream"
+            # HTTP/1.0 clients don't understand chunked transfer-encoding, so for them the
+            # end of the content is marked by closing the connection.
+            if not self._contentLength and self._request._httpVer == "HTTP/1.1":
+                self.SetHeader("Transfer-Encoding", "chunked")
+                self._chunked = True
+            data = self._makeResponseHdr(code)
         self._hdrSent = True
+        if self._stream and self._contentLength and len(data) < len(self._sendingBuf):
+            self._send_with_first_chunk(data)
+        else:
+            self._xasCli.AsyncSendData(data, onDataSent=self._on_data_sent)
+
+    # Write the headers into the send slot and fill the rest of the slot from the stream,
+    # so that the headers and the start of the content go out in a single write (and, for
+    # small files, the whole response goes out in a single write).
+    def _send_with_first_chunk(self, data):
+        hdr_len = len(data)
+        self._sendingBuf[:hdr_len] = data
+        n = self._read_stream(self._sendingBuf[hdr_len:])
+        if n is None:
+            return
+        if not self._stream:
+            self._sendingBuf = None
+        self._xasCli.AsyncSendSendingBuffer(
+            size=hdr_len + n, onDataSent=self._on_data_sent
+        )
 
     # ------------------------------------------------------------------------
 
@@ -292,7 +364,7 @@ class HttpResponse:
                 'response headers already sent for request "%s".', self._request._path
             )
             return
-        if not content:
+        if not content and code not in self._NO_BODY_CODES:
             (self._contentType, content) = self._status_code_content(code)
 
         if content:
@@ -307,10 +379,52 @@ class HttpResponse:
 
         data = self._makeResponseHdr(code)
 
+        # Queue the content separately rather than copying it onto the end of the headers.
         if content and self._request._method != "HEAD":
-            data += bytes(content)
+            self._xasCli.AsyncSendData(data)
+            data = content
+
+        self._xasCli.AsyncSendData(data, onDataSent=self._on_data_sent)
+        self._hdrSent = True
+
+    # ------------------------------------------------------------------------
 
-        self._xasCli.AsyncSendData(data, onDataSent=self._onDataSent)
+    # Returns the entity headers, e.g. Content-Type, for content of the given length, along
+    # with any headers set so far, formatted so that they can be passed to `ReturnEntity`.
+    # This allows a complete response, minus its per-request headers, to be cached.
+    def make_entity_headers(self, content_length):
+        self._contentLength = content_length
+        self._set_entity_headers()
+        hdr = self._format_headers()
+        self._headers.clear()
+        return (hdr + "\r\n").encode("ISO-8859-1")
+
+    # The content isn't copied, e.g. a memoryview of a bytes object that's frozen into flash
+    # is sent straight from flash. For a 200 response, range requests are handled as they are
+    # by `ReturnSeekable`.
+    def ReturnEntity(self, code, entity_headers, content):
+        if not isinstance(code, int) or code <= 0:
+            raise ValueError('"code" must be a positive integer.')
+        if self._hdrSent:
+            _logger.warning(
+                'response headers already sent for request "%s".', self._request._path
+            )
+            return
+        if code == 200:
+            if self._return_unsatisfiable(len(content)):
+                return
+            (code, byte_range, entity_headers) = self._select_range(
+                len(content), entity_headers
+            )
+            if byte_range:
+                content = memoryview(content)[byte_range[0] : byte_range[1] + 1]
+        self._contentLength = len(content)
+        self._set_connection_headers(code)
+        data = self._makeBaseResponseHdr(code, entity_headers)
+        if content and self._request._method != "HEAD":
+            self._xasCli.AsyncSendData(data)
+            data = content
+        self._xasCli.AsyncSendData(data, onDataSent=self._on_data_sent)
         self._hdrSent = True
 
     # ------------------------------------------------------------------------
@@ -337,15 +451,20 @@ class HttpResponse:
 
     # ------------------------------------------------------------------------
 
-    def ReturnFile(self, filename, attachmentName=None):
+    # If the file's `size` is already known, e.g. from a manifest, then it isn't stat-ed again.
+    # See `ReturnSeekable` for range requests and `entity_headers`.
+    def ReturnFile(self, filename, attachmentName=None, size=None, entity_headers=None):
         if not isinstance(filename, str) or len(filename) == 0:
             raise ValueError('"filename" must be a not empty string.')
         if attachmentName is not None and not isinstance(attachmentName, str):
             raise ValueError('"attachmentName" must be a string or None.')
-        try:
-            size = stat(filename)[6]
-        except:
-            self.ReturnNotFound()
+        if size is None:
+            try:
+                size = stat(filename)[6]
+            except:
+                self.ReturnNotFound()
+                return
+        if self._return_unsatisfiable(size):
             return
         try:
             file = open(filename, "rb")
@@ -355,10 +474,92 @@ class HttpResponse:
         if attachmentName:
             cd = 'attachment; filename="%s"' % attachmentName.replace('"', "'")
             self.SetHeader("Content-Disposition", cd)
-        if not self._contentType:
+        self.ReturnSeekable(file, size, entity_headers)
+
+    # Return the content of `stream`, which must support `seek`, `readinto` and `close` and
+    # contain `size` bytes. If the request includes a single range, e.g. "Range: bytes=1000-",
+    # then just that part of the content is returned (with 206 Partial Content), so that an
+    # interrupted download can be resumed. See `ReturnStream` for `entity_headers` - here they
+    # must end with Content-Length, as produced by `make_entity_headers` and
+    # `make-www-manifest`, so that its value can be replaced.
+    def ReturnSeekable(self, stream, size, entity_headers=None):
+        if self._return_unsatisfiable(size):
+            stream.close()
+            return
+        if not self._contentType and not entity_headers:
             raise ValueError('"ContentType" must be set')
+        (code, byte_range, entity_headers) = self._select_range(size, entity_headers)
+        if byte_range:
+            (first, last) = byte_range
+            stream.seek(first)
+            if last < size - 1:
+                stream = _RangeStream(stream, last - first + 1)
+            size = last - first + 1
         self._contentLength = size
-        self.ReturnStream(200, file)
+        self.ReturnStream(code, stream, entity_headers)
+
+    # Returns the response code, the (first, last) range of the content to send, or None for
+    # all of it, and the entity headers (with their Content-Length updated for the range).
+    def _select_range(self, size, entity_headers):
+        self.SetHeader("Accept-Ranges", "bytes")
+        byte_range = self._requested_range(size)
+        if not byte_range:
+            return 200, None, entity_headers
+        (first, last) = byte_range
+        self.SetHeader("Content-Range", "bytes %s-%s/%s" % (first, last, size))
+        if entity_headers:
+            entity_headers = self._replace_length(entity_headers, last - first + 1)
+        return 206, byte_range, entity_headers
+
+    # Replace the Content-Length line, wherever it is, of some prebuilt entity headers. The
+    # headers come from `make_entity_headers`, whose order isn't defined, or a manifest.
+    @staticmethod
+    def _replace_length(entity_headers, length):
+        line = ("Content-Length: %s" % length).encode("ISO-8859-1")
+        start = entity_headers.find(b"Content-Length:")
+        if start < 0:
+            # Insert it before the blank line that ends the headers.
+            start = end = len(entity_headers) - 2
+            line += b"\r\n"
+        else:
+            end = entity_headers.find(b"\r\n", start)
+        return entity_headers[:start] + line + entity_headers[end:]
+
+    # Respond with 416 Range Not Satisfiable, and return True, if the requested range starts
+    # beyond the end of content of the given size.
+    def _return_unsatisfiable(self, size):
+        byte_range = self._requested_range(size)
+        if not byte_range or byte_range[0] < size:
+            return False
+        self._allowCaching = False
+        self.SetHeader("Content-Range", "bytes */%s" % size)
+        self.Return(416)
+        return True
+
+    # Returns the (first, last) byte positions of the range requested for content of the given
+    # size, where `first >= size` means that the range can't be satisfied, or None if the whole
+    # content should be returned. Requests for multiple ranges are treated as requests for the
+    # whole content, as are conditional range requests (i.e. ones with If-Range).
+    def _requested_range(self, size):
+        header = self._request.Range
+        if not header.startswith("bytes=") or "," in header or self._request.IfRange:
+            return None
+        (first, sep, last) = header[6:].partition("-")
+        if not sep:
+            return None
+        try:
+            if not first.strip():
+                suffix = int(last)  # E.g. "bytes=-500" means the last 500 bytes.
+                return (max(0, size - suffix), size - 1) if suffix > 0 else (size, size)
+            first = int(first)
+            last = int(last) if last.strip() else None
+        except ValueError:
+            return None
+        if first < 0 or (last is not None and last < first):
+            return None
+        if last is None or last >= size:
+            last = size - 1
+        return first, last
 
     # ------------------------------------------------------------------------
 
@@ -499,6 +700,28 @@ class HttpResponse:
         self._check_value(name, value, value is None or isinstance(value, str))
 
 
+# ============================================================================
+# ===( _RangeStream )=========================================================
+# ============================================================================
+
+# Limits reading from a stream, that's already been positioned at the start of the range, to
+# the given number of bytes.
+class _RangeStream:
+    def __init__(self, stream, length):
+        self._stream = stream
+        self._remaining = length
+
+    def readinto(self, buf):
+        if len(buf) > self._remaining:
+            buf = memoryview(buf)[: self._remaining]
+        n = self._stream.readinto(buf)
+        self._remaining -= n
+        return n
+
+    def close(self):
+        self._stream.close()
+
+
 # ============================================================================
 # ============================================================================
 # ============================================================================
@@ -3,7 +3,8 @@
 
 
 import sys
-from time import ticks_ms, ticks_diff, ticks_add
+from errno import EAGAIN
+from time import ticks_ms, ticks_add
 
 import logging
 
@@ -34,35 +35,49 @@ class XAsyncSocketException(Exception):
 
 
 class XAsyncSocket:
+    # If `socket` is None, the async socket is created closed and a socket must be attached.
     def __init__(self, asyncSocketsPool, socket, recvBufSlot=None, sendBufSlot=None):
         if type(self) is XAsyncSocket:
             raise XAsyncSocketException(
                 "XAsyncSocket is an abstract class and must be implemented."
             )
         self._asyncSocketsPool = asyncSocketsPool
-        self._socket = socket
+        self._socket = None
         self._recvBufSlot = recvBufSlot
         self._sendBufSlot = sendBufSlot
-        self._expire_time_millis = None
+        self._expire_entry = None
         self._onClosed = None
         try:
-            socket.settimeout(0)
-            socket.setblocking(0)
             if (recvBufSlot is not None and type(recvBufSlot) is not XBufferSlot) or (
                 sendBufSlot is not None and type(sendBufSlot) is not XBufferSlot
             ):
                 raise Exception()
-            asyncSocketsPool.AddAsyncSocket(self)
+            if socket is not None:
+                self._attach(socket)
         except Exception as e:
             sys.print_exception(e)
             raise XAsyncSocketException("XAsyncSocket : Arguments are incorrects.")
 
     # ------------------------------------------------------------------------
 
+    def _attach(self, socket):
+        socket.settimeout(0)
+        socket.setblocking(0)
+        self._socket = socket
+        self._onClosed = None
+        self._asyncSocketsPool.AddAsyncSocket(self)
+
+    # ------------------------------------------------------------------------
+
+    # The deadline is held by the pool, which calls `expire` once it has passed.
     def _setExpireTimeout(self, timeoutSec):
         try:
             if timeoutSec and timeoutSec > 0:
-                self._expire_time_millis = ticks_add(ticks_ms(), timeoutSec * 1000)
+                self._removeExpireTimeout()
+                deadline = ticks_add(ticks_ms(), timeoutSec * 1000)
+                self._expire_entry = self._asyncSocketsPool.add_expire_time(
+                    self, deadline
+                )
         except:
             raise XAsyncSocketException(
                 '"timeoutSec" is incorrect to set expire timeout.'
@@ -71,7 +86,9 @@ class XAsyncSocket:
     # ------------------------------------------------------------------------
 
     def _removeExpireTimeout(self):
-        self._expire_time_millis = None
+        if self._expire_entry:
+            self._asyncSocketsPool.remove_expire_time(self._expire_entry)
+            self._expire_entry = None
 
     # ------------------------------------------------------------------------
 
@@ -81,12 +98,10 @@ class XAsyncSocket:
 
     # ------------------------------------------------------------------------
 
-    def pump_expire(self):
-        if self._expire_time_millis:
-            diff = ticks_diff(ticks_ms(), self._expire_time_millis)
-            if diff > 0:
-                self._expired()
-                self._close(XClosedReason.Timeout)
+    def expire(self):
+        self._expire_entry = None
+        self._expired()
+        self._close(XClosedReason.Timeout)
 
     # ------------------------------------------------------------------------
 
@@ -99,6 +114,7 @@ class XAsyncSocket:
     def _close(
         self, closedReason=XClosedReason.Error, triggerOnClosed=True, do_close=True
     ):
+        self._removeExpireTimeout()
         if self._asyncSocketsPool.RemoveAsyncSocket(self):
             try:
                 if do_close:
@@ -106,10 +122,6 @@ class XAsyncSocket:
             except Exception as e:
                 sys.print_exception(e)
             self._socket = None
-            if self._recvBufSlot is not None:
-                self._recvBufSlot = None
-            if self._sendBufSlot is not None:
-                self._sendBufSlot = None
             if triggerOnClosed and self._onClosed:
                 try:
                     self._onClosed(self, closedReason)
@@ -147,9 +159,16 @@ class XAsyncSocket:
 
     # ------------------------------------------------------------------------
 
+    # True if the socket isn't in the middle of anything and can be closed without loss.
+    @property
+    def is_idle(self):
+        return False
+
+    # ------------------------------------------------------------------------
+
     @property
     def ExpireTimeSec(self):
-        return self._expire_time_millis / 1000
+        return self._expire_entry[0] / 1000
 
     @property
     def OnClosed(self):
@@ -172,19 +191,13 @@ class XAsyncTCPClientException(Exception):
 class XAsyncTCPClient(XAsyncSocket):
     def __init__(self, asyncSocketsPool, cliSocket, cliAddr, recvBufSlot, sendBufSlot):
         try:
-            super().__init__(asyncSocketsPool, cliSocket, recvBufSlot, sendBufSlot)
-            self._cliAddr = cliAddr if cliAddr else ("0.0.0.0", 0)
             self._onFailsToConnect = None
             self._onConnected = None
-            self._onDataRecv = None
-            self._onDataRecvArg = None
-            self._onDataSent = None
-            self._onDataSentArg = None
-            self._sizeToRecv = None
-            self._rdLinePos = None
-            self._rdLineEncoding = None
-            self._rdBufView = None
-            self._wrBufView = None
+            # Queued [memoryview, onDataSent, onDataSentArg] segments waiting to be sent.
+            self._wr_queue = []
+            self._rd_slot_view = memoryview(recvBufSlot.Buffer)
+            self._reset(cliAddr)
+            super().__init__(asyncSocketsPool, cliSocket, recvBufSlot, sendBufSlot)
         except Exception as e:
             sys.print_exception(e)
             raise XAsyncTCPClientException(
@@ -193,6 +206,34 @@ class XAsyncTCPClient(XAsyncSocket):
 
     # ------------------------------------------------------------------------
 
+    # Once closed, a client (and its buffer slots) can be reused for a new connection.
+    def reuse(self, cliSocket, cliAddr):
+        if self._socket:
+            raise XAsyncTCPClientException("reuse : The client is still open.")
+        self._reset(cliAddr)
+        self._attach(cliSocket)
+
+    def _reset(self, cliAddr):
+        self._cliAddr = cliAddr if cliAddr else ("0.0.0.0", 0)
+        self._onDataRecv = None
+        self._onDataRecvArg = None
+        self._sizeToRecv = None
+        self._rdBufView = None
+        del self._wr_queue[:]
+        self._wr_slot_segment = None
+        # Offsets, within the receive slot, used while reading a header block.
+        self._rd_hdr_end = None
+        self._rd_hdr_start = 0
+        self._rd_hdr_scan = 0
+        self._rd_line_start = 0
+        self._rd_idle = False
+        # Bytes that were read as part of a header block but lie beyond its end, e.g. the
+        # start of a request body or a pipelined request, are kept pending in the slot.
+        self._rd_pend_start = 0
+        self._rd_pend_end = 0
+
+    # ------------------------------------------------------------------------
+
     def _expired(self):
         # This actually happens regularly. It seems to be a speed trick used by browsers,
         # they open multiple concurrent connections in _anticipation_ of needing them for
@@ -205,149 +246,208 @@ class XAsyncTCPClient(XAsyncSocket):
     # ------------------------------------------------------------------------
 
     def Close(self):
-        if self._wrBufView:
+        for segment in self._wr_queue:
             try:
-                self._socket.send(self._wrBufView)
+                self._socket.send(segment[0])
             except Exception as e:
                 sys.print_exception(e)
+                break
+        del self._wr_queue[:]
+        self._wr_slot_segment = None
         return self._close(XClosedReason.ClosedByHost)
 
     # ------------------------------------------------------------------------
 
     def OnReadyForReading(self):
-        while True:
-            if self._rdLinePos is not None:
-                # In the context of reading a line,
-                while True:
-                    try:
-                        try:
-                            b = self._socket.recv(1)
-                        except BlockingIOError as bioErr:
-                            if bioErr.errno != 35:
-                                self._close()
-                            return
-                        except:
-                            self._close()
-                            return
-                    except:
-                        self._close()
-                        return
-                    if b:
-                        if b == b"\n":
-                            lineLen = self._rdLinePos
-                            self._rdLinePos = None
-                            self._asyncSocketsPool.NotifyNextReadyForReading(
-                                self, False
-                            )
-                            self._removeExpireTimeout()
-                            if self._onDataRecv:
-                                line = self._recvBufSlot.Buffer[:lineLen]
-                                try:
-                                    line = bytes(line).decode(self._rdLineEncoding)
-                                except:
-                                    line = None
-                                try:
-                                    self._onDataRecv(self, line, self._onDataRecvArg)
-                                except Exception as ex:
-                                    sys.print_exception(ex)
-                                    raise XAsyncTCPClientException(
-                                        'Error when handling the "OnDataRecv" event : %s'
-                                        % ex
-                                    )
-                            return
-                        elif b != b"\r":
-                            if self._rdLinePos < self._recvBufSlot.Size:
-                                self._recvBufSlot.Buffer[self._rdLinePos] = ord(b)
-                                self._rdLinePos += 1
-                            else:
-                                self._close()
-                                return
-                    else:
-                        self._close(XClosedReason.ClosedByPeer)
-                        return
-            elif self._sizeToRecv:
-                # In the context of reading data,
-                recvBuf = self._rdBufView[-self._sizeToRecv :]
+        if self._rd_hdr_end is not None:
+            self._recv_header_block()
+        elif self._sizeToRecv:
+            # In the context of reading data,
+            recvBuf = self._rdBufView[-self._sizeToRecv :]
+            try:
                 try:
-                    try:
-                        n = self._socket.recv_into(recvBuf)
-                    except BlockingIOError as bioErr:
-                        if bioErr.errno != 35:
-                            self._close()
-                        return
-                    except:
+                    n = self._socket.recv_into(recvBuf)
+                except BlockingIOError as bioErr:
+                    if bioErr.errno != 35:
                         self._close()
-                        return
+                    return
                 except:
-                    try:
-                        n = self._socket.readinto(recvBuf)
-                    except:
-                        self._close()
-                        return
-                if not n:
-                    self._close(XClosedReason.ClosedByPeer)
+                    self._close()
                     return
-                self._sizeToRecv -= n
-                if not self._sizeToRecv:
-                    data = self._rdBufView
-                    self._rdBufView = None
-                    self._asyncSocketsPool.NotifyNextReadyForReading(self, False)
-                    self._removeExpireTimeout()
-                    if self._onDataRecv:
-                        try:
-                            self._onDataRecv(self, data, self._onDataRecvArg)
-                        except Exception as ex:
-                            raise XAsyncTCPClientException(
-                                'Error when handling the "OnDataRecv" event : %s' % ex
-                            )
+            except:
+                try:
+                    n = self._socket.readinto(recvBuf)
+                except:
+                    self._close()
                     return
-            else:
+            if not n:
+                self._close(XClosedReason.ClosedByPeer)
                 return
+            self._sizeToRecv -= n
+            if not self._sizeToRecv:
+                self._on_data_recv_complete()
+
+    # ------------------------------------------------------------------------
+
+    def _on_data_recv_complete(self):
+        data = self._rdBufView
+        self._rdBufView = None
+        self._asyncSocketsPool.NotifyNextReadyForReading(self, False)
+        self._removeExpireTimeout()
+        if self._onDataRecv:
+            try:
+                self._onDataRecv(self, data, self._onDataRecvArg)
+            except Exception as ex:
+                raise XAsyncTCPClientException(
+                    'Error when handling the "OnDataRecv" event : %s' % ex
+                )
 
     # ------------------------------------------------------------------------
 
+    # Rather than reading a byte at a time, read as much as is available into the receive
+    # slot and then scan what's new for the blank line that terminates the header block.
+    def _recv_header_block(self):
+        end = self._rd_hdr_end
+        if end == self._recvBufSlot.Size:
+            self._on_header_block_recv(None)  # The header block doesn't fit in the slot.
+            return
+        try:
+            n = self._socket.recv_into(self._rd_slot_view[end:])
+        except OSError as e:
+            if e.args[0] != EAGAIN:
+                self._close()
+            return
+        except:
+            self._close()
+            return
+        if not n:
+            self._close(XClosedReason.ClosedByPeer)
+            return
+        self._rd_hdr_end = end + n
+        self._scan_header_block()
+
+    # ------------------------------------------------------------------------
+
+    def _scan_header_block(self):
+        buf = self._recvBufSlot.Buffer
+        end = self._rd_hdr_end
+        line_start = self._rd_line_start
+        pos = self._rd_hdr_scan
+        while pos < end:
+            if buf[pos] == 0x0A:  # LF
+                line_end = pos
+                if line_end > line_start and buf[line_end - 1] == 0x0D:  # CR
+                    line_end -= 1
+                if line_end == line_start:
+                    if line_start != self._rd_hdr_start:
+                        self._rd_pend_start = pos + 1
+                        self._rd_pend_end = end
+                        self._on_header_block_recv(
+                            self._rd_slot_view[self._rd_hdr_start : line_start]
+                        )
+                        return
+                    # Ignore blank lines that precede the start of the block.
+                    self._rd_hdr_start = pos + 1
+                line_start = pos + 1
+            pos += 1
+        self._rd_line_start = line_start
+        self._rd_hdr_scan = pos
+
+    # ------------------------------------------------------------------------
+
+    def _on_header_block_recv(self, block):
+        self._rd_hdr_end = None
+        self._asyncSocketsPool.NotifyNextReadyForReading(self, False)
+        self._removeExpireTimeout()
+        if self._onDataRecv:
+            try:
+                self._onDataRecv(self, block, self._onDataRecvArg)
+            except Exception as ex:
+                sys.print_exception(ex)
+                raise XAsyncTCPClientException(
+                    'Error when handling the "OnDataRecv" event : %s' % ex
+                )
+
+    # ------------------------------------------------------------------------
+
+    # Send as many of the queued segments as the socket will currently accept, rather than
+    # waiting to be notified again after each one, and call each segment's callback once sent.
     def OnReadyForWriting(self):
-        if self._wrBufView:
+        while self._wr_queue and self._socket:
+            segment = self._wr_queue[0]
             try:
-                n = self._socket.send(self._wrBufView)
+                n = self._socket.send(segment[0])
             except:
                 return
-            self._wrBufView = self._wrBufView[n:]
-            if not self._wrBufView:
+            if n < len(segment[0]):
+                segment[0] = segment[0][n:]
+                return
+            self._wr_queue.pop(0)
+            if segment is self._wr_slot_segment:
+                self._wr_slot_segment = None
+            if not self._wr_queue:
                 self._asyncSocketsPool.NotifyNextReadyForWriting(self, False)
-                if self._onDataSent:
-                    try:
-                        self._onDataSent(self, self._onDataSentArg)
-                    except Exception as ex:
-                        raise XAsyncTCPClientException(
-                            'Error when handling the "OnDataSent" event : %s' % ex
-                        )
+            if segment[1]:
+                try:
+                    segment[1](self, segment[2])
+                except Exception as ex:
+                    raise XAsyncTCPClientException(
+                        'Error when handling the "OnDataSent" event : %s' % ex
+                    )
 
     # ------------------------------------------------------------------------
 
-    def AsyncRecvLine(
-        self, lineEncoding="UTF-8", onLineRecv=None, onLineRecvArg=None, timeoutSec=None
+    # Receives a block of lines terminated by a blank line, e.g. an HTTP request line and
+    # headers, and passes it, as a memoryview into the receive slot, to `onHeaderRecv`.
+    # The block passed includes the line terminators but not the terminating blank line.
+    # If the block doesn't fit into the receive slot then `None` is passed instead.
+    # If `idle` is true, the socket is considered idle until the first byte is received.
+    def async_recv_header_block(
+        self, onHeaderRecv=None, onHeaderRecvArg=None, timeoutSec=None, idle=False
     ):
-        if self._rdLinePos is not None or self._sizeToRecv:
+        if self._rd_hdr_end is not None or self._sizeToRecv:
             raise XAsyncTCPClientException(
-                "AsyncRecvLine : Already waiting asynchronous receive."
+                "async_recv_header_block : Already waiting asynchronous receive."
             )
         if self._socket:
+            # Move any pending bytes to the start of the slot and scan them first.
+            pending = self._take_pending(self._recvBufSlot.Size)
+            n = len(pending)
+            if n:
+                self._recvBufSlot.Buffer[:n] = bytes(pending)
+            self._rd_hdr_start = 0
+            self._rd_hdr_scan = 0
+            self._rd_line_start = 0
+            self._rd_hdr_end = n
+            self._rd_idle = idle
             self._setExpireTimeout(timeoutSec)
-            self._rdLinePos = 0
-            self._rdLineEncoding = lineEncoding
-            self._onDataRecv = onLineRecv
-            self._onDataRecvArg = onLineRecvArg
+            self._onDataRecv = onHeaderRecv
+            self._onDataRecvArg = onHeaderRecvArg
             self._asyncSocketsPool.NotifyNextReadyForReading(self, True)
+            if n:
+                self._scan_header_block()
             return True
         return False
 
     # ------------------------------------------------------------------------
 
+    # Returns up to `size` of the pending bytes as a memoryview into the receive slot.
+    def _take_pending(self, size):
+        start = self._rd_pend_start
+        end = min(self._rd_pend_end, start + size)
+        if end == self._rd_pend_end:
+            self._rd_pend_start = 0
+            self._rd_pend_end = 0
+        else:
+            self._rd_pend_start = end
+        return self._rd_slot_view[start:end]
+
+    # ------------------------------------------------------------------------
+
     def AsyncRecvData(
         self, size=None, onDataRecv=None, onDataRecvArg=None, timeoutSec=None
     ):
-        if self._rdLinePos is not None or self._sizeToRecv:
+        if self._rd_hdr_end is not None or self._sizeToRecv:
             raise XAsyncTCPClientException(
                 "AsyncRecvData : Already waiting asynchronous receive."
             )
@@ -356,8 +456,16 @@ class XAsyncTCPClient(XAsyncSocket):
                 size = self._recvBufSlot.Size
             elif not isinstance(size, int) or size <= 0:
                 raise XAsyncTCPClientException('AsyncRecvData : "size" is incorrect.')
+            start = self._rd_pend_start
+            pending = self._take_pending(size)
+            n = len(pending)
             if size <= self._recvBufSlot.Size:
-                self._rdBufView = memoryview(self._recvBufSlot.Buffer)[:size]
+                if start + size > self._recvBufSlot.Size:
+                    # Move the pending bytes to the start of the slot to make room.
+                    self._recvBufSlot.Buffer[:n] = bytes(pending)
+                    start = 0
+                # Any pending bytes are already in place at the start of the view.
+                self._rdBufView = self._rd_slot_view[start : start + size]
             else:
                 try:
                     self._rdBufView = memoryview(bytearray(size))
@@ -365,27 +473,34 @@ class XAsyncTCPClient(XAsyncSocket):
                     raise XAsyncTCPClientException(
                         "AsyncRecvData : No enought memory to receive %s bytes." % size
                     )
+                self._rdBufView[:n] = pending
             self._setExpireTimeout(timeoutSec)
-            self._sizeToRecv = size
+            self._sizeToRecv = size - n
             self._onDataRecv = onDataRecv
             self._onDataRecvArg = onDataRecvArg
             self._asyncSocketsPool.NotifyNextReadyForReading(self, True)
+            if not self._sizeToRecv:
+                self._on_data_recv_complete()
             return True
         return False
 
     # ------------------------------------------------------------------------
 
+    def _queue_send(self, data, onDataSent, onDataSentArg):
+        segment = [data, onDataSent, onDataSentArg]
+        self._wr_queue.append(segment)
+        if len(self._wr_queue) == 1:
+            self._asyncSocketsPool.NotifyNextReadyForWriting(self, True)
+        return segment
+
+    # ------------------------------------------------------------------------
+
+    # The data is queued without being copied, so it must not be modified until it's been sent.
     def AsyncSendData(self, data, onDataSent=None, onDataSentArg=None):
         if self._socket:
             try:
                 if bytes([data[0]]):
-                    if self._wrBufView:
-                        self._wrBufView = memoryview(bytes(self._wrBufView) + data)
-                    else:
-                        self._wrBufView = memoryview(data)
-                    self._onDataSent = onDataSent
-                    self._onDataSentArg = onDataSentArg
-                    self._asyncSocketsPool.NotifyNextReadyForWriting(self, True)
+                    self._queue_send(memoryview(data), onDataSent, onDataSentArg)
                     return True
             except Exception as e:
                 sys.print_exception(e)
@@ -395,7 +510,7 @@ class XAsyncTCPClient(XAsyncSocket):
     # ------------------------------------------------------------------------
 
     def AsyncSendSendingBuffer(self, size=None, onDataSent=None, onDataSentArg=None):
-        if self._wrBufView:
+        if self._wr_slot_segment:
             raise XAsyncTCPClientException(
                 "AsyncSendBufferSlot : Already waiting to send data."
             )
@@ -403,15 +518,20 @@ class XAsyncTCPClient(XAsyncSocket):
             if size is None:
                 size = self._sendBufSlot.Size
             if size > 0 and size <= self._sendBufSlot.Size:
-                self._wrBufView = memoryview(self._sendBufSlot.Buffer)[:size]
-                self._onDataSent = onDataSent
-                self._onDataSentArg = onDataSentArg
-                self._asyncSocketsPool.NotifyNextReadyForWriting(self, True)
+                view = memoryview(self._sendBufSlot.Buffer)[:size]
+                segment = self._queue_send(view, onDataSent, onDataSentArg)
+                self._wr_slot_segment = segment
                 return True
         return False
 
     # ------------------------------------------------------------------------
 
+    @property
+    def is_idle(self):
+        return self._rd_idle and self._rd_hdr_end == 0
+
+    # ------------------------------------------------------------------------
+
     @property
     def CliAddr(self):
         return self._cliAddr
@@ -420,6 +540,10 @@ class XAsyncTCPClient(XAsyncSocket):
     def SendingBuffer(self):
         return self._sendBufSlot.Buffer
 
+    @property
+    def RecvBufSlotSize(self):
+        return self._recvBufSlot.Size
+
     @property
     def OnFailsToConnect(self):
         return self._onFailsToConnect
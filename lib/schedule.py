@@ -99,6 +99,13 @@ class Scheduler(object):
         # Number of seconds until `next_run`.
         return self.next_run - now()
 
+    def idle_ms(self):
+        # Number of milliseconds until `next_run` (0 if it has already passed) or
+        # None if there are no jobs.
+        if not self.jobs:
+            return None
+        return max(0, int(self.idle_seconds * 1000))
+
 
 class Job(object):
     # A periodic job as used by `Scheduler`.
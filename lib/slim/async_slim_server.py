@@ -0,0 +1,333 @@
+import logging
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+try:
+    from sys import print_exception
+except ImportError:
+    from traceback import print_exception  # CPython.
+
+from micro_web_srv_2.http_request import HttpRequest
+from micro_web_srv_2.libs.xasync_sockets import (
+    XBufferSlot,
+    XClosedReason,
+    XAsyncTCPClientException,
+)
+from slim.slim_server import process_request, header_filter
+from slim.slim_config import SlimConfig
+
+_logger = logging.getLogger("async_server")
+
+
+# An alternative to `SlimServer` that's driven by `asyncio` (or `uasyncio` on MicroPython)
+# streams rather than by pumping `poll` events. This makes it easy to run other tasks, e.g.
+# reading sensors, alongside the server. The same modules, e.g. `WebRouteModule` and
+# `FileserverModule`, can be used with either server.
+class AsyncSlimServer:
+    # The backlog argument to `listen` isn't optional for the ESP32 port.
+    # Internally any passed in backlog value is clipped to a maximum of 255.
+    _LISTEN_MAX = 255
+
+    # Slot size from MicroWebSrv2.SetEmbeddedConfig.
+    _SLOT_SIZE = 1024
+
+    # `asyncio.start_server` uses `getaddrinfo` and MicroPython's doesn't accept "" for
+    # INADDR_ANY so "0.0.0.0" is used instead.
+    def __init__(self, address="0.0.0.0", port=80, config=SlimConfig()):
+        self._config = config
+        self._address = address
+        self._port = port
+        self._server = None
+
+        # As with `SlimServer`, the buffer slots are allocated up front.
+        self._free_slots = [
+            (XBufferSlot(self._SLOT_SIZE), XBufferSlot(self._SLOT_SIZE))
+            for _ in range(config.max_connections)
+        ]
+        self._slot_freed = asyncio.Event()
+        self._clients = []
+
+        self._modules = []
+        self._header_filter = header_filter(config, self._modules)
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._on_connect, self._address, self._port, backlog=self._LISTEN_MAX
+        )
+
+    def shutdown(self):
+        self._server.close()
+        for client in self._clients:
+            client.cancel()
+
+    def add_module(self, instance):
+        self._modules.append(instance)
+        self._header_filter = header_filter(self._config, self._modules)
+
+    def _process_request_modules(self, request):
+        process_request(self._modules, request)
+
+    async def _on_connect(self, reader, writer):
+        # If all buffer slots are in use then close an idle connection, if there is one, and
+        # wait until it (or any other connection) has been closed and its slots released.
+        while not self._free_slots:
+            self._close_idle()
+            self._slot_freed.clear()
+            await self._slot_freed.wait()
+
+        slots = self._free_slots.pop()
+        client = _StreamClient(self._config, reader, writer, slots)
+        self._clients.append(client)
+        try:
+            request = HttpRequest(
+                self._config, client, process_request=self._process_request_modules
+            )
+            request.start(self._header_filter)
+            await client.run()
+        finally:
+            self._clients.remove(client)
+            self._free_slots.append(slots)
+            self._slot_freed.set()
+
+    def _close_idle(self):
+        for client in self._clients:
+            if client.is_idle:
+                client.cancel()
+                return
+
+
+# Implements the subset of the `XAsyncTCPClient` interface that's used by `HttpRequest` and
+# `HttpResponse`. Their callbacks are still called synchronously, it's just that `run` awaits
+# the reads and writes that they request rather than these being driven by `poll` events.
+class _StreamClient:
+    def __init__(self, config, reader, writer, slots):
+        self._timeout_sec = config.timeout_sec
+        self._reader = reader
+        self._writer = writer
+        self._recvBufSlot, self._sendBufSlot = slots
+        self._cliAddr = writer.get_extra_info("peername")
+        self._task = asyncio.current_task()
+        self._wake = asyncio.Event()
+        self._onClosed = None
+        self._closed = False
+
+        # The pending receive, if any, as a coroutine function and its arguments.
+        self._recv = None
+        self._recv_args = None
+        self._recv_timeout = None
+        self._onDataRecv = None
+        self._onDataRecvArg = None
+        self._rd_idle = False
+        # Bytes read beyond the end of a header block, i.e. the start of the content.
+        self._rd_buf = b""
+
+        # Queued [data, onDataSent, onDataSentArg] segments waiting to be sent.
+        self._wr_queue = []
+        self._wr_slot_segment = None
+
+    async def run(self):
+        reason = XClosedReason.Error
+        try:
+            while not self._closed:
+                if self._wr_queue:
+                    await self._send_queued()
+                elif self._recv:
+                    recv = self._recv
+                    self._recv = None
+                    await asyncio.wait_for(recv(*self._recv_args), self._recv_timeout)
+                else:
+                    # E.g. a module is preparing its response outside of `OnRequest`.
+                    self._wake.clear()
+                    await self._wake.wait()
+            reason = XClosedReason.ClosedByHost
+            await self._send_queued()
+        except asyncio.TimeoutError:
+            _logger.debug("connection from %s expired", self._cliAddr)
+            reason = XClosedReason.Timeout
+        except EOFError:
+            reason = XClosedReason.ClosedByPeer
+        except asyncio.CancelledError:
+            reason = XClosedReason.ClosedByHost
+        except Exception as e:
+            print_exception(e)
+        finally:
+            self._close(reason)
+            try:
+                self._writer.close()
+                await self._writer.wait_closed()
+            except Exception:
+                pass
+
+    # Any queued data is sent before the connection is closed.
+    def Close(self):
+        if self._closed:
+            return False
+        self._closed = True
+        self._wake.set()
+        return True
+
+    def cancel(self):
+        self._rd_idle = False
+        self._task.cancel()
+
+    def _close(self, reason):
+        self._closed = True
+        self._rd_idle = False
+        self._recv = None
+        self._wr_queue = []
+        self._wr_slot_segment = None
+        onClosed = self._onClosed
+        self._onClosed = None
+        if onClosed:
+            onClosed(self, reason)
+
+    def _set_recv(self, recv, args, timeoutSec, onDataRecv, onDataRecvArg):
+        if self._recv:
+            raise XAsyncTCPClientException("Already waiting asynchronous receive.")
+        if self._closed:
+            return False
+        self._recv = recv
+        self._recv_args = args
+        self._recv_timeout = timeoutSec if timeoutSec else self._timeout_sec
+        self._onDataRecv = onDataRecv
+        self._onDataRecvArg = onDataRecvArg
+        self._wake.set()
+        return True
+
+    # See `XAsyncTCPClient.async_recv_header_block`.
+    def async_recv_header_block(
+        self, onHeaderRecv=None, onHeaderRecvArg=None, timeoutSec=None, idle=False
+    ):
+        self._rd_idle = idle
+        return self._set_recv(
+            self._recv_header_block, (), timeoutSec, onHeaderRecv, onHeaderRecvArg
+        )
+
+    async def _recv_header_block(self):
+        buf = self._recvBufSlot.Buffer
+        size = len(buf)
+        end = 0
+        while True:
+            # Allow for the blank line that ends the block even if the slot is full.
+            line = await self._readline(max(size - end, 2))
+            self._rd_idle = False
+            if line == b"\r\n" or line == b"\n":
+                if end:
+                    break
+                continue  # Ignore blank lines that precede the start of the block.
+            n = len(line) if line else 0
+            if not line or end + n > size:
+                end = None  # The header block doesn't fit in the slot.
+                self._rd_buf = b""
+                break
+            buf[end : end + n] = line
+            end += n
+        block = None if end is None else memoryview(buf)[:end]
+        self._onDataRecv(self, block, self._onDataRecvArg)
+
+    # Unlike the stream's `readline`, which buffers however much a client sends without a
+    # newline, this reads no more than `limit` bytes and returns None if there's no newline
+    # within them. Anything read beyond the newline is kept for the next read.
+    async def _readline(self, limit):
+        while True:
+            i = self._rd_buf.find(b"\n")
+            if i >= 0:
+                line = self._rd_buf[: i + 1]
+                self._rd_buf = self._rd_buf[i + 1 :]
+                return line
+            if len(self._rd_buf) >= limit:
+                return None
+            data = await self._reader.read(limit - len(self._rd_buf))
+            if not data:
+                raise EOFError()
+            self._rd_buf += data
+
+    def AsyncRecvData(
+        self, size=None, onDataRecv=None, onDataRecvArg=None, timeoutSec=None
+    ):
+        if size is None:
+            size = self._recvBufSlot.Size
+        elif not isinstance(size, int) or size <= 0:
+            raise XAsyncTCPClientException('AsyncRecvData : "size" is incorrect.')
+        return self._set_recv(
+            self._recv_data, (size,), timeoutSec, onDataRecv, onDataRecvArg
+        )
+
+    async def _recv_data(self, size):
+        data = self._rd_buf[:size]
+        self._rd_buf = self._rd_buf[size:]
+        if len(data) < size:
+            # If the connection is closed early, an EOFError (or subclass) is raised.
+            data += await self._reader.readexactly(size - len(data))
+        self._onDataRecv(self, data, self._onDataRecvArg)
+
+    # Each segment is copied by the stream's `write`, so after `drain` its memory, e.g. that
+    # of the send slot, can be reused and the segment's callback is called.
+    async def _send_queued(self):
+        queue = self._wr_queue
+        self._wr_queue = []
+        self._wr_slot_segment = None
+        for segment in queue:
+            self._writer.write(segment[0])
+        await asyncio.wait_for(self._writer.drain(), self._timeout_sec)
+        for segment in queue:
+            if segment[1]:
+                segment[1](self, segment[2])
+
+    def _queue_send(self, data, onDataSent, onDataSentArg):
+        segment = [data, onDataSent, onDataSentArg]
+        self._wr_queue.append(segment)
+        self._wake.set()
+        return segment
+
+    def AsyncSendData(self, data, onDataSent=None, onDataSentArg=None):
+        if self._closed:
+            return False
+        self._queue_send(data, onDataSent, onDataSentArg)
+        return True
+
+    def AsyncSendSendingBuffer(self, size=None, onDataSent=None, onDataSentArg=None):
+        if self._wr_slot_segment:
+            raise XAsyncTCPClientException(
+                "AsyncSendBufferSlot : Already waiting to send data."
+            )
+        if self._closed:
+            return False
+        if size is None:
+            size = self._sendBufSlot.Size
+        if size > 0 and size <= self._sendBufSlot.Size:
+            view = memoryview(self._sendBufSlot.Buffer)[:size]
+            self._wr_slot_segment = self._queue_send(view, onDataSent, onDataSentArg)
+            return True
+        return False
+
+    # Websockets, i.e. `WsManager`, need a socket that can be registered with a poller.
+    def detach_socket(self):
+        raise XAsyncTCPClientException("streams cannot be detached")
+
+    @property
+    def is_idle(self):
+        return self._rd_idle
+
+    @property
+    def CliAddr(self):
+        return self._cliAddr
+
+    @property
+    def SendingBuffer(self):
+        return self._sendBufSlot.Buffer
+
+    @property
+    def RecvBufSlotSize(self):
+        return self._recvBufSlot.Size
+
+    @property
+    def OnClosed(self):
+        return self._onClosed
+
+    @OnClosed.setter
+    def OnClosed(self, value):
+        self._onClosed = value
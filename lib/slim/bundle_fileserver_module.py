@@ -0,0 +1,82 @@
+import io
+import json
+
+from slim.fileserver_module import FileserverModule
+
+
+# Serves the files packed into a bundle, generated by `make-www-manifest --bundle`, rather
+# than individual files. The bundle is kept open and each file is read from its offset in
+# the bundle, so there's no need to resolve paths or open files while handling requests.
+class BundleFileserverModule(FileserverModule):
+    def __init__(self, bundle, cache_size=0):
+        self._bundle = bundle
+        self._archive = None
+        super().__init__(None, None, cache_size)
+
+    # Returns a dict that maps URL paths to (offset, size, entity headers, ETag, MIME type,
+    # content encoding) tuples, where offset is relative to the start of the bundle.
+    def _load_manifest(self):
+        self._archive = open(self._bundle, "rb")
+        line = self._archive.readline()
+        index_len = int(line)
+        index = json.loads(self._archive.read(index_len))
+        data_start = len(line) + index_len
+        # Paths, e.g. "/" and "/index.html", that map to the same file share the same tuple.
+        entries = {}
+        for path in index:
+            details = index[path]
+            offset = details["offset"]
+            if offset not in entries:
+                entries[offset] = (
+                    data_start + offset,
+                    details["size"],
+                    details["headers"].encode(),
+                    details["etag"],
+                    details["mime"],
+                    details["encoding"],
+                )
+            index[path] = entries[offset]
+        return index
+
+    def _open(self, entry):
+        return _SliceStream(self._archive, entry[0], entry[1])
+
+    def _return_file(self, response, entry):
+        response.ReturnSeekable(self._open(entry), entry[1], entry[2])
+
+
+# A read-only stream for the part of the bundle that contains a particular file. Several such
+# streams can be in use at once, for different responses, so each one seeks to its current
+# position before reading. Subclassing `IOBase` allows it to be passed to the likes of
+# `DeflateIO`, that expect a native stream.
+class _SliceStream(io.IOBase):
+    def __init__(self, archive, offset, size):
+        self._archive = archive
+        self._start = offset
+        self._pos = offset
+        self._end = offset + size
+
+    def seek(self, pos):
+        self._pos = self._start + pos
+
+    def readinto(self, buf):
+        remaining = self._end - self._pos
+        if len(buf) > remaining:
+            buf = memoryview(buf)[:remaining]
+        self._archive.seek(self._pos)
+        n = self._archive.readinto(buf)
+        self._pos += n
+        return n
+
+    def read(self, size=-1):
+        remaining = self._end - self._pos
+        if size < 0 or size > remaining:
+            size = remaining
+        self._archive.seek(self._pos)
+        data = self._archive.read(size)
+        self._pos += len(data)
+        return data
+
+    # The bundle itself is left open.
+    def close(self):
+        pass
@@ -0,0 +1,90 @@
+from time import ticks_ms, ticks_diff
+
+
+# A min-heap of [deadline, item] entries ordered by deadline, where deadlines are `ticks_ms`
+# values. As `ticks_ms` values wrap around, deadlines are compared using `ticks_diff` (this is
+# also why `heapq` can't be used). Rather than being removed from the middle of the heap, a
+# cancelled entry just has its item cleared and is discarded once it reaches the top.
+class DeadlineHeap:
+    # The heap is compacted when it has at least this many entries and over half are cancelled.
+    _COMPACT_MIN = 8
+
+    def __init__(self):
+        self._heap = []
+        self._cancelled = 0
+
+    def push(self, deadline, item):
+        entry = [deadline, item]
+        self._heap.append(entry)
+        self._sift_up(len(self._heap) - 1)
+        return entry
+
+    def cancel(self, entry):
+        if entry[1] is not None:
+            entry[1] = None
+            self._cancelled += 1
+            heap = self._heap
+            if self._cancelled > len(heap) // 2 and len(heap) >= self._COMPACT_MIN:
+                self._heap = [e for e in heap if e[1] is not None]
+                self._cancelled = 0
+                for i in range(len(self._heap) // 2 - 1, -1, -1):
+                    self._sift_down(i)
+
+    # Returns the number of milliseconds until the earliest deadline (0 if it has already
+    # passed) or None if there are no deadlines.
+    def ms_until_next(self):
+        self._discard_cancelled()
+        if not self._heap:
+            return None
+        return max(0, ticks_diff(self._heap[0][0], ticks_ms()))
+
+    # Removes and returns the item with the earliest deadline, if that deadline has passed
+    # as of `now`, otherwise returns None.
+    def pop_expired(self, now):
+        self._discard_cancelled()
+        if not self._heap or ticks_diff(self._heap[0][0], now) > 0:
+            return None
+        return self._pop()[1]
+
+    def _discard_cancelled(self):
+        while self._heap and self._heap[0][1] is None:
+            self._pop()
+            self._cancelled -= 1
+
+    def _pop(self):
+        heap = self._heap
+        last = heap.pop()
+        if not heap:
+            return last
+        top = heap[0]
+        heap[0] = last
+        self._sift_down(0)
+        return top
+
+    def _sift_up(self, i):
+        heap = self._heap
+        entry = heap[i]
+        while i > 0:
+            parent = (i - 1) >> 1
+            if ticks_diff(heap[parent][0], entry[0]) <= 0:
+                break
+            heap[i] = heap[parent]
+            i = parent
+        heap[i] = entry
+
+    def _sift_down(self, i):
+        heap = self._heap
+        size = len(heap)
+        entry = heap[i]
+        while True:
+            child = 2 * i + 1
+            if child >= size:
+                break
+            right = child + 1
+            if right < size and ticks_diff(heap[right][0], heap[child][0]) < 0:
+                child = right
+            if ticks_diff(entry[0], heap[child][0]) <= 0:
+                break
+            heap[i] = heap[child]
+            i = child
+        heap[i] = entry
@@ -0,0 +1,92 @@
+import os
+import logging
+from binascii import hexlify
+from hashlib import sha256
+
+from shim import join
+
+
+_logger = logging.getLogger("file_uploader")
+
+
+# Handles file uploads, e.g. config files or firmware images, writing the content straight to
+# flash as it's received (so uploads of any size use the same small amount of memory). Its
+# `upload` method is the handler for a streaming route with a `name` parameter, e.g.:
+#
+#     RegisteredRoute(HttpMethod.PUT, "/api/upload/<name>", uploader.upload, stream_body=True)
+#
+# The content is written to a temporary file and only renamed to `name`, replacing any
+# existing file, once it's all been received. If the query string includes a `sha256` value,
+# e.g. "/api/upload/config.json?sha256=9f86d0...", then the SHA-256 hash of the content must
+# match it or the temporary file is deleted and the response is 400 Bad Request.
+# If the connection is lost mid-upload, the temporary file is deleted. The size must be known
+# up front, to check that it'll fit, so requests without a Content-Length header, e.g. ones
+# using chunked transfer encoding, get 411 Length Required.
+class FileUploader:
+    _TMP_SUFFIX = ".part"
+    _LENGTH_REQUIRED = 411
+
+    def __init__(self, directory, max_size=None):
+        self._directory = directory
+        self._max_size = max_size
+
+    def upload(self, request, args):
+        name = args["name"]
+        response = request.Response
+        if name.startswith(".") or name.endswith(self._TMP_SUFFIX):
+            response.ReturnForbidden()
+            return
+        if not request.GetHeader("content-length"):
+            response.Return(self._LENGTH_REQUIRED)
+            return
+        size = request.ContentLength
+        if not self._has_room(size):
+            response.ReturnEntityTooLarge()
+            return
+
+        filename = join(self._directory, name)
+        tmp_filename = filename + self._TMP_SUFFIX
+        digest = sha256()
+        file = open(tmp_filename, "wb")
+        received = False
+        try:
+            while True:
+                chunk = yield
+                if chunk is None:
+                    break
+                file.write(chunk)
+                digest.update(chunk)
+            received = True
+        finally:
+            file.close()
+            # E.g. the connection was lost (see `GeneratorExit`) or the write failed.
+            if not received:
+                os.remove(tmp_filename)
+
+        actual = hexlify(digest.digest()).decode()
+        expected = request.QueryParams.get("sha256")
+        if expected and expected.lower() != actual:
+            _logger.warning("%s doesn't match its SHA-256 hash", name)
+            os.remove(tmp_filename)
+            response.ReturnBadRequest()
+            return
+
+        self._replace(tmp_filename, filename)
+        response.ReturnJSON(201, {"name": name, "size": size, "sha256": actual})
+
+    def _has_room(self, size):
+        if self._max_size is not None and size > self._max_size:
+            return False
+        # `statvfs` returns the fragment size and the number of free blocks at indices 1 and 4.
+        stats = os.statvfs(self._directory)
+        return size <= stats[1] * stats[4]
+
+    # On littlefs, `rename` atomically replaces any existing file. On FAT, it fails if the
+    # target exists so the existing file has to be removed first.
+    @staticmethod
+    def _replace(src, dst):
+        try:
+            os.rename(src, dst)
+        except OSError:
+            os.remove(dst)
+            os.rename(src, dst)
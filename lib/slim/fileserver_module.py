@@ -1,6 +1,10 @@
+import json
 import logging
+from collections import OrderedDict
+from os import stat
 
-from shim import isdir, exists
+from shim import isdir, exists, join
+from slim.gunzip_stream import GunzipStream
 
 
 _logger = logging.getLogger("fileserver_module")
@@ -8,31 +12,240 @@ _logger = logging.getLogger("fileserver_module")
 
 class FileserverModule:
     _DEFAULT_PAGE = "index.html"
+    _MANIFEST = "manifest.json"
 
-    def __init__(self, mime_types, root="www"):
+    # Headers needed, beyond the server's default whitelist, for conditional requests and
+    # content negotiation.
+    REQUEST_HEADERS = ("if-none-match", "accept-encoding")
+
+    # If `root` contains a manifest, generated by `make-www-manifest`, then paths are resolved
+    # using it, rather than by checking the filesystem, and `mime_types` is ignored - the
+    # manifest's MIME types, taken from `slim/mime_types.py`, override it.
+    # If `cache_size` is non-zero, responses (minus their per-request headers) are cached in
+    # memory, up to a total of `cache_size` bytes, with the least recently used ones being
+    # discarded first. Files that are bigger than `cache_size` are always read from flash.
+    # Files that are only stored gzipped are decompressed, as they're sent, for clients that
+    # don't accept gzip (such responses aren't cached).
+    def __init__(self, mime_types, root="www", cache_size=0):
         self._mime_types = mime_types
         self._root = root
+        self._manifest = self._load_manifest()
+        self._cache_size = cache_size
+        self._cache_used = 0
+        # Maps URL paths to (entity headers, content) pairs, ordered from least recently used.
+        self._cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    # Returns a dict that maps URL paths to (filename, size, entity headers, ETag, MIME type,
+    # content encoding) tuples or None if there's no manifest.
+    def _load_manifest(self):
+        filename = join(self._root, self._MANIFEST)
+        if not exists(filename):
+            return None
+        with open(filename) as file:
+            manifest = json.load(file)
+        # Paths, e.g. "/" and "/index.html", that map to the same file share the same tuple.
+        entries = {}
+        for path in manifest:
+            details = manifest[path]
+            name = details["file"]
+            if name not in entries:
+                entries[name] = (
+                    join(self._root, name),
+                    details["size"],
+                    details["headers"].encode(),
+                    details.get("etag"),
+                    details["mime"],
+                    details["encoding"],
+                )
+            manifest[path] = entries[name]
+        return manifest
 
     def OnRequest(self, request):
         if request.IsUpgrade or request.Method not in ("GET", "HEAD"):
             return
 
+        entry = None
+        if self._manifest is not None:
+            entry = self._manifest.get(self._strip_slash(request.Path))
+            if not entry:
+                request.Response.ReturnNotFound()
+                return
+            if self._not_modified(request, entry[3]):
+                return
+
+        # Cached content may be compressed so it's only used if the client accepts gzip.
+        accepts_gzip = self._accepts_gzip(request)
+        if accepts_gzip:
+            cached = self._cache.pop(request.Path, None)
+            if cached:
+                # Reinsert it as the most recently used.
+                self._cache[request.Path] = cached
+                self.cache_hits += 1
+                request.Response.ReturnEntity(200, cached[0], cached[1])
+                return
+
+        if not entry:
+            entry = self._resolve_file(request)
+            if not entry:
+                return
+
+        (_, _, entity_headers, _, mime_type, encoding) = entry
+        if encoding and not accepts_gzip:
+            self._return_decompressed(request, entry)
+            return
+        if not entity_headers:
+            self._set_entity(request.Response, mime_type, encoding)
+        if self._cache_size and accepts_gzip and self._return_cached(request, entry):
+            return
+        self._return_file(request.Response, entry)
+
+    # A client that doesn't send Accept-Encoding is treated as not accepting gzip. Strictly,
+    # it accepts any encoding, but minimal clients, e.g. captive portal probes, often don't
+    # send the header and can't decompress.
+    @staticmethod
+    def _accepts_gzip(request):
+        for coding in request.AcceptEncodings:
+            params = coding.split(";")
+            name = params[0].strip().lower()
+            if name == "gzip" or name == "*":
+                for param in params[1:]:
+                    param = param.strip()
+                    if param.startswith("q="):
+                        try:
+                            return float(param[2:]) > 0
+                        except ValueError:
+                            return False
+                return True
+        return False
+
+    # The decompressed content differs from what's stored so its length is unknown (and it's
+    # sent using chunked encoding) and it doesn't have the stored content's ETag. If there
+    # isn't enough memory for the window that decompressing needs (up to 32KiB), then the
+    # response is 503 Service Unavailable.
+    def _return_decompressed(self, request, entry):
+        try:
+            size = entry[1]
+            if size is None:
+                size = stat(entry[0])[6]
+            file = self._open(entry)
+        except:
+            request.Response.ReturnForbidden()
+            return
+        try:
+            stream = GunzipStream(file, size)
+        except MemoryError:
+            file.close()
+            _logger.error("not enough memory to decompress %s", request.Path)
+            request.Response.ReturnServiceUnavailable()
+            return
+        response = request.Response
+        response.AllowCaching = True
+        response.ContentType = entry[4]
+        response.SetHeader("Vary", "Accept-Encoding")
+        response.ReturnStream(200, stream)
+
+    # Returns a readable stream for an entry's content. Subclasses that don't store content
+    # as individual files override this and `_return_file`.
+    @staticmethod
+    def _open(entry):
+        return open(entry[0], "rb")
+
+    @staticmethod
+    def _return_file(response, entry):
+        (filename, size, entity_headers, _, _, _) = entry
+        response.ReturnFile(filename, size=size, entity_headers=entity_headers)
+
+    @staticmethod
+    def _set_entity(response, mime_type, encoding):
+        response.AllowCaching = True
+        response.ContentType = mime_type
+        if encoding:
+            response.SetHeader("Content-Encoding", encoding)
+            response.SetHeader("Vary", "Accept-Encoding")
+
+    # If the client already has the current version of the file, i.e. one of the ETags in its
+    # If-None-Match header matches, then respond with 304 Not Modified (and no content).
+    @staticmethod
+    def _not_modified(request, etag):
+        if not etag or not FileserverModule._etag_matches(request.IfNoneMatch, etag):
+            return False
+        request.Response.AllowCaching = True
+        request.Response.SetHeader("ETag", etag)
+        request.Response.ReturnNotModified()
+        return True
+
+    # If-None-Match uses weak comparison, i.e. a W/ prefix is ignored.
+    @staticmethod
+    def _etag_matches(if_none_match, etag):
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag == "*" or tag == etag or (tag.startswith("W/") and tag[2:] == etag):
+                return True
+        return False
+
+    # Resolve the file using the filesystem. Returns an entry, like those in the manifest but
+    # where only the filename, MIME type and encoding are known, or None if the request has
+    # already been responded to.
+    def _resolve_file(self, request):
         (filename, compressed) = self._resolve_physical_path(request.Path)
-        if filename:
-            ct = self._get_mime_type_from_filename(filename)
-            if ct:
-                request.Response.AllowCaching = True
-                request.Response.ContentType = ct
-
-                if compressed:
-                    request.Response.SetHeader("Content-Encoding", "gzip")
-                    filename = compressed
-                request.Response.ReturnFile(filename)
-            else:
-                _logger.warning("no MIME type for %s", filename)
-                request.Response.ReturnForbidden()
-        else:
+        if not filename:
             request.Response.ReturnNotFound()
+            return None
+        ct = self._get_mime_type_from_filename(filename)
+        if not ct:
+            _logger.warning("no MIME type for %s", filename)
+            request.Response.ReturnForbidden()
+            return None
+        if compressed:
+            return compressed, None, None, None, ct, "gzip"
+        return filename, None, None, None, ct, None
+
+    # Read the file into memory, cache the response and return it. Responses that can't fit
+    # in the cache aren't read into memory (and don't count as misses). Returns false if the
+    # response has been left to the caller.
+    def _return_cached(self, request, entry):
+        (filename, size, entity_headers, _, _, _) = entry
+        try:
+            if size is None:
+                size = stat(filename)[6]
+        except:
+            return False  # Leave it to `ReturnFile` to respond.
+        if size > self._cache_size:
+            return False
+        if not entity_headers:
+            # This consumes the headers set on the response, so from here on the file must
+            # be returned with these entity headers.
+            entity_headers = request.Response.make_entity_headers(size)
+            entry = (filename, size, entity_headers) + entry[3:]
+        entry_size = len(entity_headers) + size
+        if entry_size > self._cache_size:
+            self._return_file(request.Response, entry)
+            return True
+        self.cache_misses += 1
+        try:
+            file = self._open(entry)
+            try:
+                content = file.read()
+            finally:
+                file.close()
+        except:
+            self._return_file(request.Response, entry)
+            return True
+        while self._cache_used + entry_size > self._cache_size:
+            (headers, evicted) = self._cache.pop(next(iter(self._cache)))
+            self._cache_used -= len(headers) + len(evicted)
+        self._cache[request.Path] = (entity_headers, content)
+        self._cache_used += entry_size
+        request.Response.ReturnEntity(200, entity_headers, content)
+        return True
+
+    @staticmethod
+    def _strip_slash(url_path):
+        if len(url_path) > 1 and url_path.endswith("/"):
+            return url_path[:-1]
+        return url_path
 
     def _resolve_physical_path(self, url_path):
         if ".." in url_path:
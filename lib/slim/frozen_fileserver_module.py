@@ -0,0 +1,76 @@
+import io
+
+from slim.fileserver_module import FileserverModule
+
+
+# Serves the files in a module, generated by `make-www-manifest --frozen`, that's been frozen
+# into the firmware. Frozen bytes constants are stored in flash and are sent directly from
+# there, i.e. there's no filesystem access and the content isn't copied into RAM.
+class FrozenFileserverModule(FileserverModule):
+    # `assets` is the generated module's `ASSETS` dict.
+    def __init__(self, assets):
+        self._assets = assets
+        super().__init__(None, None)
+
+    # Returns a `FrozenFileserverModule` for the frozen module with the given name or, if
+    # there's no such module, the result of calling `fallback`, e.g. a `FileserverModule`.
+    @staticmethod
+    def create(module_name, fallback):
+        try:
+            module = __import__(module_name)
+        except ImportError:
+            return fallback()
+        return FrozenFileserverModule(module.ASSETS)
+
+    # Returns a dict that maps URL paths to (content, size, entity headers, ETag, MIME type,
+    # content encoding) tuples.
+    def _load_manifest(self):
+        manifest = {}
+        for path in self._assets:
+            (content, entity_headers, etag, mime_type, encoding) = self._assets[path]
+            manifest[path] = (
+                content,
+                len(content),
+                entity_headers,
+                etag,
+                mime_type,
+                encoding,
+            )
+        return manifest
+
+    @staticmethod
+    def _open(entry):
+        return _MemoryStream(entry[0])
+
+    @staticmethod
+    def _return_file(response, entry):
+        response.ReturnEntity(200, entry[2], entry[0])
+
+
+# A read-only stream for a bytes object that, unlike `io.BytesIO`, doesn't copy it. It's only
+# used when content has to be decompressed. Subclassing `IOBase` allows it to be passed to the
+# likes of `DeflateIO`, that expect a native stream.
+class _MemoryStream(io.IOBase):
+    def __init__(self, content):
+        self._content = memoryview(content)
+        self._pos = 0
+
+    def seek(self, pos):
+        self._pos = pos
+
+    def readinto(self, buf):
+        n = min(len(buf), len(self._content) - self._pos)
+        buf[:n] = self._content[self._pos : self._pos + n]
+        self._pos += n
+        return n
+
+    def read(self, size=-1):
+        remaining = len(self._content) - self._pos
+        if size < 0 or size > remaining:
+            size = remaining
+        data = bytes(self._content[self._pos : self._pos + size])
+        self._pos += size
+        return data
+
+    def close(self):
+        pass
@@ -0,0 +1,67 @@
+try:
+    from deflate import DeflateIO, GZIP  # MicroPython 1.21 onwards.
+
+    def _decompress_io(file, wbits):
+        return DeflateIO(file, GZIP, wbits)
+
+
+except ImportError:
+    from zlib import DecompIO  # Earlier versions, where zlib is a weak link to uzlib.
+
+    # 16 + means expect a gzip header.
+    def _decompress_io(file, wbits):
+        return DecompIO(file, 16 + wbits)
+
+
+# The smallest and largest windows, i.e. 2^wbits bytes, that a decompressor can be given.
+_MIN_WBITS = 9
+_MAX_WBITS = 15
+
+# The amount of content read up front by `GunzipStream`.
+_PRIME_SIZE = 64
+
+
+# Deflate never refers back further than the start of the content, so a window that holds the
+# whole decompressed content is always big enough, whatever window it was compressed with.
+def _window_bits(content_size):
+    wbits = _MIN_WBITS
+    while wbits < _MAX_WBITS and (1 << wbits) < content_size:
+        wbits += 1
+    return wbits
+
+
+# Wraps a gzipped file such that reading from it returns the decompressed content, i.e. it
+# can be passed to `HttpResponse.ReturnStream`. The gzip header doesn't record the window
+# size that the content was compressed with, e.g. `gzip` always uses 32KiB, but the trailer
+# records the decompressed size, so the window is no bigger than that. `file` must support
+# `seek(pos)` and contain `size` bytes. Creating a `GunzipStream` allocates the window buffer,
+# which may only happen on the first read, so some content is read straight away. If there
+# isn't enough memory then `MemoryError` is raised, i.e. before a response has been started.
+class GunzipStream:
+    def __init__(self, file, size):
+        self._file = file
+        file.seek(size - 4)
+        trailer = file.read(4)
+        file.seek(0)
+        wbits = _window_bits(int.from_bytes(trailer, "little"))
+        self._decompressor = _decompress_io(file, wbits)
+        self._primed = self._decompressor.read(_PRIME_SIZE)
+
+    # Fills `buf` unless the end of the content has been reached.
+    def readinto(self, buf):
+        n = 0
+        if self._primed:
+            n = min(len(buf), len(self._primed))
+            buf[:n] = self._primed[:n]
+            self._primed = self._primed[n:]
+        size = len(buf)
+        while n < size:
+            count = self._decompressor.readinto(memoryview(buf)[n:])
+            if not count:
+                break
+            n += count
+        return n
+
+    def close(self):
+        self._decompressor = None
+        self._file.close()
@@ -0,0 +1,11 @@
+# Maps file suffixes to MIME types. The captive portal passes this to `FileserverModule` and
+# `make-www-manifest` uses it to fill in each file's MIME type in the manifest, so the two
+# can't disagree about a file's type.
+MIME_TYPES = {
+    "html": "text/html",
+    "css": "text/css",
+    "js": "application/javascript",
+    "woff2": "font/woff2",
+    "ico": "image/x-icon",
+    "svg": "image/svg+xml",
+}
@@ -0,0 +1,110 @@
+import select
+from time import ticks_ms
+
+from slim.deadline_heap import DeadlineHeap
+
+
+# Even without threading we can handle multiple sockets concurrently. However each socket
+# needs its own send and receive buffer slots, so to bound memory usage the number of sockets
+# is limited. Once the limit is reached no more sockets can be added and new connections have
+# to wait (in the listen backlog) until an existing one is closed.
+class MultiSocketPool:
+    def __init__(self, poller, max_sockets):
+        self._poller = poller
+        self._max_sockets = max_sockets
+        # Maps socket objects to [async_socket, mask] pairs.
+        self._entries = {}
+        # The expire times of all the sockets.
+        self._deadlines = DeadlineHeap()
+
+    def has_capacity(self):
+        return len(self._entries) < self._max_sockets
+
+    def has_idle(self):
+        return self._find_idle() is not None
+
+    # True if no socket is in the middle of anything, e.g. they're all kept-alive connections
+    # waiting for another request, or there are no sockets.
+    def all_idle(self):
+        for entry in self._entries.values():
+            if not entry[0].is_idle:
+                return False
+        return True
+
+    # Close an idle socket, if there is one, in order to free up its buffer slots.
+    def close_idle(self):
+        async_socket = self._find_idle()
+        if async_socket is None:
+            return False
+        async_socket.Close()
+        return True
+
+    def _find_idle(self):
+        for entry in self._entries.values():
+            if entry[0].is_idle:
+                return entry[0]
+        return None
+
+    def AddAsyncSocket(self, async_socket):
+        s = async_socket.GetSocketObj()
+        assert s not in self._entries, "socket has already been added"
+        self._entries[s] = [async_socket, select.POLLERR | select.POLLHUP]
+
+    def RemoveAsyncSocket(self, async_socket):
+        s = async_socket.GetSocketObj()
+        if self._entries.pop(s, None) is None:
+            return False
+        self._poller.unregister(s)
+        return True  # Caller XAsyncSocket._close will close the underlying socket.
+
+    def NotifyNextReadyForReading(self, async_socket, notify):
+        self._update(async_socket, select.POLLIN, notify)
+
+    def NotifyNextReadyForWriting(self, async_socket, notify):
+        self._update(async_socket, select.POLLOUT, notify)
+
+    def _update(self, async_socket, event, set):
+        s = async_socket.GetSocketObj()
+        entry = self._entries[s]
+        if set:
+            entry[1] |= event
+        else:
+            entry[1] &= ~event
+        self._poller.register(s, entry[1])
+
+    def pump(self, s, event):
+        entry = self._entries.get(s)
+        if entry is None:
+            return
+        async_socket = entry[0]
+
+        # Each handler may result in the socket being closed and removed from the pool.
+        if event & select.POLLIN:
+            event &= ~select.POLLIN
+            async_socket.OnReadyForReading()
+
+        if event & select.POLLOUT and s in self._entries:
+            event &= ~select.POLLOUT
+            async_socket.OnReadyForWriting()
+
+        # If there are still bits left in event...
+        if event and s in self._entries:
+            async_socket.OnExceptionalCondition()
+
+    def add_expire_time(self, async_socket, deadline):
+        return self._deadlines.push(deadline, async_socket)
+
+    def remove_expire_time(self, entry):
+        self._deadlines.cancel(entry)
+
+    # Returns the number of milliseconds until the next socket expires, or None if none will.
+    def ms_until_expire(self):
+        return self._deadlines.ms_until_next()
+
+    def pump_expire(self):
+        now = ticks_ms()
+        while True:
+            async_socket = self._deadlines.pop_expired(now)
+            if not async_socket:
+                break
+            async_socket.expire()
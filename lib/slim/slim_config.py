@@ -1,5 +1,28 @@
 class SlimConfig:
     _DEFAULT_TIMEOUT = 4  # 4 seconds - 2 seconds is too low for some mobile browsers.
+    # Each concurrent connection costs a send and a receive buffer slot (1KiB each).
+    _DEFAULT_MAX_CONNECTIONS = 1
+    # By default, a connection is closed after one request, i.e. there's no keep-alive.
+    _DEFAULT_MAX_REQUESTS = 1
+    _DEFAULT_KEEP_ALIVE_TIMEOUT = 2
+    # Only these request headers (lowercase) are kept, plus any that modules ask for.
+    # None means keep all headers. Note that `HttpRequest` properties for headers that
+    # aren't listed here, i.e. `UserAgent`, `Cookies`, `Referer`, `AcceptLanguages`,
+    # `CacheControl`, `AcceptEncodings` and `IfNoneMatch`, return an empty string or list,
+    # as if the client hadn't sent the header, unless the header is added to the whitelist.
+    _DEFAULT_HEADER_WHITELIST = (
+        "host",
+        "content-length",
+        "transfer-encoding",
+        "content-type",
+        "accept",
+        "connection",
+        "upgrade",
+        "sec-websocket-key",
+        "origin",
+        "range",
+        "if-range",
+    )
 
     def __init__(
         self,
@@ -7,8 +30,16 @@ class SlimConfig:
         allow_all_origins=False,
         not_found_url=None,
         server_name="Slim Server (MicroPython)",
+        max_connections=_DEFAULT_MAX_CONNECTIONS,
+        max_requests=_DEFAULT_MAX_REQUESTS,
+        keep_alive_timeout_sec=_DEFAULT_KEEP_ALIVE_TIMEOUT,
+        header_whitelist=_DEFAULT_HEADER_WHITELIST,
     ):
         self.timeout_sec = timeout_sec
         self.allow_all_origins = allow_all_origins
         self.not_found_url = not_found_url
         self.server_name = server_name
+        self.max_connections = max_connections
+        self.max_requests = max_requests
+        self.keep_alive_timeout_sec = keep_alive_timeout_sec
+        self.header_whitelist = header_whitelist
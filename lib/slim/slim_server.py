@@ -3,15 +3,45 @@ import socket
 import logging
 
 from micro_web_srv_2.http_request import HttpRequest
-from micro_web_srv_2.libs.xasync_sockets import XBufferSlot, XAsyncTCPClient
-from slim.single_socket_pool import SingleSocketPool
+from micro_web_srv_2.libs.xasync_sockets import XAsyncTCPClient, XBufferSlot
+from slim.multi_socket_pool import MultiSocketPool
 from slim.slim_config import SlimConfig
 
 _logger = logging.getLogger("server")
 
 
+_RESPONSE_PENDING = object()
+
+
+# Offer the request to each module, in turn, until one of them responds (or says it will).
+def process_request(modules, request):
+    for modInstance in modules:
+        try:
+            r = modInstance.OnRequest(request)
+            if r is _RESPONSE_PENDING or request.Response.HeadersSent:
+                return
+        except Exception as ex:
+            name = type(modInstance).__name__
+            _logger.error('Exception in request handler of module "%s" (%s).', name, ex)
+
+    request.Response.ReturnNotImplemented()
+
+
+# Returns the names of the request headers that `HttpRequest` should keep, along with the
+# lengths of those names (so most unwanted headers can be skipped without decoding them), or
+# None if all headers should be kept. A module can ask for headers, beyond those in the
+# config's whitelist, by listing their lowercase names in a `REQUEST_HEADERS` class attribute.
+def header_filter(config, modules):
+    if config.header_whitelist is None:
+        return None
+    names = set(config.header_whitelist)
+    for module in modules:
+        names.update(getattr(module, "REQUEST_HEADERS", ()))
+    return names, set(len(name) for name in names)
+
+
 class SlimServer:
-    RESPONSE_PENDING = object()
+    RESPONSE_PENDING = _RESPONSE_PENDING
 
     # The backlog argument to `listen` isn't optional for the ESP32 port.
     # Internally any passed in backlog value is clipped to a maximum of 255.
@@ -25,15 +55,17 @@ class SlimServer:
         self._config = config
         self._server_socket = self._create_server_socket(address, port)
 
-        poller.register(
-            self._server_socket, select.POLLIN | select.POLLERR | select.POLLHUP
-        )
+        self._poller = poller
+        self._accepting = False
+        self._set_accepting(True)
 
-        self._socket_pool = SingleSocketPool(poller)
+        self._socket_pool = MultiSocketPool(poller, config.max_connections)
+        # Requests (and the clients and responses that they own) are created as needed, up
+        # to the maximum number of connections, and reused once their connections are closed.
+        self._requests = []
 
         self._modules = []
-        self._recv_buf_slot = XBufferSlot(self._SLOT_SIZE)
-        self._send_buf_slot = XBufferSlot(self._SLOT_SIZE)
+        self._header_filter = header_filter(config, self._modules)
 
     def shutdown(self, poller):
         poller.unregister(self._server_socket)
@@ -41,20 +73,10 @@ class SlimServer:
 
     def add_module(self, instance):
         self._modules.append(instance)
+        self._header_filter = header_filter(self._config, self._modules)
 
     def _process_request_modules(self, request):
-        for modInstance in self._modules:
-            try:
-                r = modInstance.OnRequest(request)
-                if r is self.RESPONSE_PENDING or request.Response.HeadersSent:
-                    return
-            except Exception as ex:
-                name = type(modInstance).__name__
-                _logger.error(
-                    'Exception in request handler of module "%s" (%s).', name, ex
-                )
-
-        request.Response.ReturnNotImplemented()
+        process_request(self._modules, request)
 
     def _create_server_socket(self, address, port):
         server_socket = socket.socket()
@@ -66,31 +88,69 @@ class SlimServer:
         return server_socket
 
     def pump(self, s, event):
-        # If not already processing a request, see if a new request has come in.
-        if not self._socket_pool.has_async_socket():
-            if s != self._server_socket:
-                return
-
-            if event != select.POLLIN:
-                raise Exception("unexpected event {} on server socket".format(event))
-
-            client_socket, client_address = self._server_socket.accept()
-
-            # XAsyncTCPClient adds itself to _socket_pool (via the ctor of its parent XAsyncSocket).
-            tcp_client = XAsyncTCPClient(
-                self._socket_pool,
-                client_socket,
-                client_address,
-                self._recv_buf_slot,
-                self._send_buf_slot,
-            )
-            # HttpRequest registers itself to receive data via tcp_client and once
-            # it's read the request, it calls the given process_request callback.
-            HttpRequest(
-                self._config, tcp_client, process_request=self._process_request_modules
-            )
-        else:  # Else process the existing request.
+        if s != self._server_socket:
             self._socket_pool.pump(s, event)
+        else:
+            self._accept(event)
+        self._update_accepting()
+
+    def _accept(self, event):
+        if event != select.POLLIN:
+            raise Exception("unexpected event {} on server socket".format(event))
+
+        # If all buffer slots are in use, and none can be freed up by closing an idle connection,
+        # e.g. a kept-alive connection, then leave the new connection in the listen backlog.
+        if not self._socket_pool.has_capacity() and not self._socket_pool.close_idle():
+            return
+
+        client_socket, client_address = self._server_socket.accept()
+        request = self._take_request()
+        # The client adds itself to _socket_pool and the request registers itself to receive
+        # data via the client. Once it's read the request, it calls _process_request_modules.
+        request.XAsyncTCPClient.reuse(client_socket, client_address)
+        request.start(self._header_filter)
+
+    def _take_request(self):
+        for request in self._requests:
+            if request.XAsyncTCPClient.GetSocketObj() is None:
+                return request
+        tcp_client = XAsyncTCPClient(
+            self._socket_pool,
+            None,
+            None,
+            XBufferSlot(self._SLOT_SIZE),
+            XBufferSlot(self._SLOT_SIZE),
+        )
+        request = HttpRequest(
+            self._config, tcp_client, process_request=self._process_request_modules
+        )
+        self._requests.append(request)
+        return request
 
     def pump_expire(self):
         self._socket_pool.pump_expire()
+        self._update_accepting()
+
+    # A pending connection leaves the server socket readable, so if it can't be accepted then
+    # `ipoll` would return immediately, again and again, i.e. the event loop would spin. So stop
+    # polling the server socket for POLLIN until a connection can be accepted.
+    def _update_accepting(self):
+        pool = self._socket_pool
+        self._set_accepting(pool.has_capacity() or pool.has_idle())
+
+    def _set_accepting(self, accepting):
+        if accepting != self._accepting:
+            self._accepting = accepting
+            mask = select.POLLERR | select.POLLHUP
+            if accepting:
+                mask |= select.POLLIN
+            self._poller.register(self._server_socket, mask)
+
+    # True if no request is currently being received or responded to.
+    def is_idle(self):
+        return self._socket_pool.all_idle()
+
+    # Returns the number of milliseconds until `pump_expire` next needs to be called, or None
+    # if there are currently no client sockets that can expire.
+    def ms_until_expire(self):
+        return self._socket_pool.ms_until_expire()
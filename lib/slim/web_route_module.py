@@ -3,6 +3,7 @@ import sys
 import logging
 
 from slim.slim_server import SlimServer
+from micro_web_srv_2.libs.url_utils import UrlUtils
 
 
 _logger = logging.getLogger("route_module")
@@ -19,8 +20,12 @@ class HttpMethod:
     PATCH = "PATCH"
 
 
+# A route path can include parameters, e.g. "/api/network/<ssid>", in which case the handler
+# is called with a second argument, a dict mapping each parameter name to the corresponding
+# path segment, e.g. `{"ssid": "MyNetwork"}`. Otherwise, the handler is just passed the request.
+# If `stream_body` is true, the handler must be a generator function, see `_stream_request`.
 class RegisteredRoute:
-    def __init__(self, method, routePath, handler):
+    def __init__(self, method, routePath, handler, stream_body=False):
         self._check_value("method", method, isinstance(method, str) and len(method) > 0)
         self._check_value(
             "routePath",
@@ -34,30 +39,89 @@ class RegisteredRoute:
         self.Handler = handler
         self.Method = method
         self.RoutePath = routePath
+        self.StreamBody = stream_body
+        self.ArgNames = [
+            segment[1:-1] for segment in routePath.split("/") if _is_param(segment)
+        ]
 
     def _check_value(self, name, value, condition):
         if not condition:
             raise ValueError('{} is not a valid value for "{}"'.format(value, name))
 
 
+def _is_param(segment):
+    return segment.startswith("<") and segment.endswith(">")
+
+
+# A node in the trie of parameterized routes. `children` maps (lowercase) literal segments to
+# nodes, `param` is the node for any other segment and `routes` maps methods to the routes
+# that end at this node.
+class _RouteNode:
+    def __init__(self):
+        self.children = {}
+        self.param = None
+        self.routes = {}
+
+
 class WebRouteModule:
     _MAX_CONTENT_LEN = 16 * 1024  # Content len from MicroWebSrv2.SetEmbeddedConfig
 
+    # The routes are indexed up front. Routes without parameters go in a dict, keyed by method
+    # and path, and the rest go in a trie, keyed by path segment, so that resolving a route
+    # doesn't involve checking each route in turn.
     def __init__(self, routes, max_content_len=_MAX_CONTENT_LEN):
         self._max_content_len = max_content_len
-        self._registeredRoutes = routes
+        self._static_routes = {}
+        # Maps each static route path to the methods that it supports (for the Allow header).
+        self._static_methods = {}
+        self._route_trie = _RouteNode()
+        for route in routes:
+            self._add_route(route)
+
+    def _add_route(self, route):
+        if not route.ArgNames:
+            path = route.RoutePath.lower()
+            self._static_routes[(route.Method, path)] = route
+            self._static_methods.setdefault(path, []).append(route.Method)
+            return
+        node = self._route_trie
+        for segment in route.RoutePath.split("/")[1:]:
+            if _is_param(segment):
+                if not node.param:
+                    node.param = _RouteNode()
+                node = node.param
+            else:
+                segment = segment.lower()
+                child = node.children.get(segment)
+                if not child:
+                    child = _RouteNode()
+                    node.children[segment] = child
+                node = child
+        node.routes[route.Method] = route
 
     def OnRequest(self, request):
-        route_result = self._resolve_route(request.Method, request.Path)
+        route_result = self._resolve_route(
+            request.Method, request.Path, request.RawPath
+        )
         if not route_result:
             return
+        if isinstance(route_result, list):
+            request.Response.SetHeader("Allow", ", ".join(route_result))
+            request.Response.ReturnMethodNotAllowed()
+            return
 
         def route_request():
-            self._route_request(request, route_result)
+            return self._route_request(request, route_result)
 
         cnt_len = request.ContentLength
+        if route_result[0].StreamBody:
+            if cnt_len and request.Method in ("GET", "HEAD"):
+                request.Response.ReturnBadRequest()
+                return
+            self._stream_request(request, route_result, cnt_len)
+            return SlimServer.RESPONSE_PENDING
         if not cnt_len:
-            route_request()
+            return route_request()
         elif request.Method not in ("GET", "HEAD"):
             if cnt_len <= self._max_content_len:
                 try:
@@ -73,22 +137,142 @@ class WebRouteModule:
         else:
             request.Response.ReturnBadRequest()
 
+    # A handler can return `SlimServer.RESPONSE_PENDING` to say that it'll respond later.
     def _route_request(self, request, route_result):
+        (route, args) = route_result
         try:
-            route_result.Handler(request)
+            if route.ArgNames:
+                result = route.Handler(request, args)
+            else:
+                result = route.Handler(request)
+            if result is SlimServer.RESPONSE_PENDING:
+                return result
             if not request.Response.HeadersSent:
-                _logger.warning("no response was sent from route %s.", route_result)
-                request.Response.ReturnNotImplemented()
+                self._no_response(request, route)
+        except Exception as ex:
+            self._handler_failed(request, route, ex)
+
+    @staticmethod
+    def _no_response(request, route):
+        _logger.warning("no response was sent from route %s.", route.RoutePath)
+        request.Response.ReturnNotImplemented()
+
+    @staticmethod
+    def _handler_failed(request, route, ex):
+        sys.print_exception(ex)
+        _logger.error("exception raised from route %s", route.RoutePath)
+        request.Response.ReturnInternalServerError()
+
+    # A streaming route's handler is a generator function. It's started before any content is
+    # received and runs to its first `yield` (or it can respond and return straight away, e.g.
+    # to reject the request). Each piece of content is then sent into the generator, i.e. it's
+    # the value of a `yield` expression, and once all the content has been received, None is
+    # sent in and the handler must respond. A piece of content is only valid until the handler
+    # yields again. If the handler responds or returns early, the rest of the content is
+    # ignored (and the connection is closed after the response). If the connection is closed,
+    # or times out, before the handler completes, `GeneratorExit` is raised at its `yield`.
+    def _stream_request(self, request, route_result, cnt_len):
+        (route, args) = route_result
+        response = request.Response
+        client = request.XAsyncTCPClient
+        chained = client.OnClosed
+
+        # MicroPython doesn't finalize generators when they're collected, so one that's left
+        # suspended would never run its `finally` clauses (and would keep hold of `request`,
+        # which is reused for later connections). So close it explicitly.
+        def finish():
+            if client.OnClosed is on_closed:
+                client.OnClosed = chained
+            try:
+                body.close()
+            except Exception as ex:
+                sys.print_exception(ex)
+
+        def on_closed(xasCli, closedReason):
+            _logger.warning("connection closed during route %s.", route.RoutePath)
+            finish()
+            if chained:
+                chained(xasCli, closedReason)
+
+        # Returns true if the handler hasn't responded and is waiting for more content.
+        def send(value):
+            try:
+                body.send(value)
+                if not response.HeadersSent:
+                    return True
+            except StopIteration:
+                if not response.HeadersSent:
+                    self._no_response(request, route)
+            except Exception as ex:
+                self._handler_failed(request, route, ex)
+            finish()
+            return False
+
+        def on_content_recv():
+            if send(None):
+                finish()
+                self._no_response(request, route)
+
+        try:
+            if route.ArgNames:
+                body = route.Handler(request, args)
+            else:
+                body = route.Handler(request)
         except Exception as ex:
-            sys.print_exception(ex)
-            _logger.error("exception raised from route %s", route_result)
-            request.Response.ReturnInternalServerError()
+            self._handler_failed(request, route, ex)
+            return
+        if send(None):
+            client.OnClosed = on_closed
+            request.async_data_stream(cnt_len, send, on_content_recv)
+
+    # Returns a (route, args) pair, where args is None for a route without parameters, a list
+    # of the methods that are supported if the path matches but the method doesn't, or None.
+    # Parameterized routes are matched against `raw_path`, which is split into segments before
+    # each one is percent-decoded, so that a parameter can contain "/" (as "%2F") or "+".
+    def _resolve_route(self, method, path, raw_path):
+        path = self._strip_slash(path)
+        lower_path = path.lower()
+        route = self._static_routes.get((method, lower_path))
+        if route:
+            return route, None
+        static_methods = self._static_methods.get(lower_path)
 
-    def _resolve_route(self, method, path):
-        path = path.lower()
+        values = []
+        segments = self._strip_slash(raw_path).split("/")
+        node = self._match(self._route_trie, segments, 1, values)
+        if node:
+            route = node.routes.get(method)
+            if route:
+                return route, dict(zip(route.ArgNames, values))
+            methods = list(node.routes)
+            for m in static_methods or ():
+                if m not in methods:
+                    methods.append(m)
+            return methods
+
+        return static_methods
+
+    @staticmethod
+    def _strip_slash(path):
         if len(path) > 1 and path.endswith("/"):
-            path = path[:-1]
-        for regRoute in self._registeredRoutes:
-            if regRoute.Method == method and regRoute.RoutePath == path:
-                return regRoute
+            return path[:-1]
+        return path
+
+    # Literal segments take precedence over parameters, e.g. "/api/network/scan" matches a
+    # route with that path, if there is one, before it matches "/api/network/<ssid>".
+    def _match(self, node, segments, i, values):
+        if i == len(segments):
+            return node if node.routes else None
+        segment = segments[i]
+        child = node.children.get(UrlUtils.Unquote(segment).lower())
+        if child:
+            found = self._match(child, segments, i + 1, values)
+            if found:
+                return found
+        if node.param and segment:
+            values.append(UrlUtils.Unquote(segment))
+            found = self._match(node.param, segments, i + 1, values)
+            if found:
+                return found
+            values.pop()
         return None
@@ -0,0 +1,44 @@
+from time import ticks_ms, ticks_diff
+
+
+# Scanning for access points takes one to three seconds, during which nothing else can run,
+# so rather than scanning for every request, the results are cached and rescanned at most
+# every so often. An access point that's visible via several BSSIDs, e.g. a mesh network,
+# appears once with its strongest RSSI.
+class AccessPointCache:
+    # Access points that haven't been seen for this long are dropped.
+    _MAX_AGE_MS = 60 * 1000
+
+    def __init__(self, wlan):
+        self._wlan = wlan
+        # Maps SSIDs to (SSID, RSSI, authmode, last seen) tuples.
+        self._points = {}
+        self._scanned = None
+
+    # Scan and merge the results into the cache.
+    def scan(self):
+        now = ticks_ms()
+        strongest = {}
+        # Tuples are  of the form (SSID, BSSID, channel, RSSI, authmode, hidden).
+        for p in self._wlan.scan():
+            point = strongest.get(p[0])
+            if not point or p[3] > point[1]:
+                strongest[p[0]] = (p[0], p[3], p[4], now)
+        # Results from this scan replace those from earlier scans.
+        self._points.update(strongest)
+        for ssid in list(self._points):
+            if ticks_diff(now, self._points[ssid][3]) > self._MAX_AGE_MS:
+                del self._points[ssid]
+        self._scanned = now
+
+    # Returns a list of (SSID, RSSI, authmode) tuples, strongest first.
+    def points(self):
+        points = [p[:3] for p in self._points.values()]
+        points.sort(key=lambda p: p[1], reverse=True)
+        return points
+
+    # Returns the number of seconds since the last scan or None if there hasn't been one.
+    def age_sec(self):
+        if self._scanned is None:
+            return None
+        return ticks_diff(ticks_ms(), self._scanned) // 1000
@@ -3,15 +3,21 @@
 from slim.slim_server import SlimServer
 from slim.slim_config import SlimConfig
 from slim.fileserver_module import FileserverModule
+from slim.bundle_fileserver_module import BundleFileserverModule
+from slim.frozen_fileserver_module import FrozenFileserverModule
+from slim.mime_types import MIME_TYPES
 from slim.web_route_module import WebRouteModule, RegisteredRoute, HttpMethod
 from micro_dns_srv import MicroDNSSrv
-from shim import join, dirname
+from shim import join, dirname, exists
 
 import network
 import select
 import logging
 
 from schedule import Scheduler, CancelJob
+from event_loop import EventLoop
+from wifi_setup.access_point_cache import AccessPointCache
+from wifi_setup.connect_attempt import ConnectAttempt
 
 
 _logger = logging.getLogger("captive_portal")
@@ -20,40 +26,70 @@ _logger = logging.getLogger("captive_portal")
 # Rather than present a login page, this is a captive portal that lets you set up
 # access to your network. See docs/captive-portal.md for more about captive portals.
 class CaptivePortal:
-    def run(self, essid, connect):
+    _MAX_CONNECTIONS = 4
+    _MAX_REQUESTS = 16
+    # Enough to keep the small, but constantly requested, files like index.html in memory.
+    _CACHE_SIZE = 4 * 1024
+    # The name of the module, generated by `make-www-manifest --frozen`, that's used, if it's
+    # been frozen into the firmware, in preference to the files in `www`.
+    _FROZEN_WWW = "wifi_setup_www"
+    # Rescan for access points at most this often (and only if they've been requested since
+    # the last scan).
+    _SCAN_INTERVAL_SEC = 10
+    # The scheduler's clock only has a resolution of a second so there's no point polling a
+    # connection attempt more often than this.
+    _CONNECT_POLL_SEC = 1
+
+    # `connect(ssid, password)` must start connecting and return a `ConnectAttempt`.
+    # If `reconnect` is given, it's called, with delays set by the `RetryPolicy` `retry`, to
+    # start connecting to a known network, again returning a `ConnectAttempt`, and the portal
+    # is shut down if one of these attempts succeeds.
+    def run(self, essid, connect, reconnect=None, retry=None):
         self._schedule = Scheduler()
         self._connect = connect
-        self._alive = True
         self._timeout_job = None
+        self._attempt = None
+        self._attempt_id = 0
+        self._reconnect = reconnect
+        self._retry = retry
+        self._retries = 0
+        self._reconnect_attempt = None
+        if reconnect:
+            self._schedule_reconnect()
 
         self._ap = network.WLAN(network.AP_IF)
         self._ap.active(True)
         self._ap.config(essid=essid)  # You can't set values before calling active(...).
 
+        # Scan before starting the servers, when there's nothing to hold up.
+        self._access_points = AccessPointCache(self._ap)
+        self._access_points.scan()
+        self._scan_wanted = False
+        self._schedule.every(self._SCAN_INTERVAL_SEC).seconds.do(self._rescan)
+
         poller = select.poll()
 
         addr = self._ap.ifconfig()[0]
         slim_server = self._create_slim_server(poller, essid)
+        self._slim_server = slim_server
         dns = self._create_dns(poller, addr)
 
         _logger.info("captive portal web server and DNS started on %s", addr)
 
-        # If no timeout is given `ipoll` blocks and the for-loop goes forever.
-        # With a timeout the for-loop exits every time the timeout expires.
-        # I.e. the underlying iterable reports that it has no more elements.
-        while self._alive:
-            # Under the covers polling is done with a non-blocking ioctl call and the timeout
-            # (or blocking forever) is implemented with a hard loop, so there's nothing to be
-            # gained (e.g. reduced power consumption) by using a timeout greater than 0.
-            for (s, event) in poller.ipoll(0):
-                # If event has bits other than POLLIN or POLLOUT then print it.
-                if event & ~(select.POLLIN | select.POLLOUT):
-                    self._print_select_event(event)
-                slim_server.pump(s, event)
-                dns.pump(s, event)
-
-            slim_server.pump_expire()  # Expire inactive client sockets.
-            self._schedule.run_pending()
+        def pump(s, event):
+            # If event has bits other than POLLIN or POLLOUT then print it.
+            if event & ~(select.POLLIN | select.POLLOUT):
+                self._print_select_event(event)
+            slim_server.pump(s, event)
+            dns.pump(s, event)
+
+        # Block in `ipoll` until there's a socket event, a client socket needs to be expired
+        # or a scheduled job needs to be run, rather than spinning and starving the WiFi stack.
+        self._loop = EventLoop(poller)
+        self._loop.add_pump(pump)
+        self._loop.add_timer(slim_server.ms_until_expire, slim_server.pump_expire)
+        self._loop.add_timer(self._schedule.idle_ms, self._schedule.run_pending)
+        self._loop.run()
 
         slim_server.shutdown(poller)
         dns.shutdown(poller)
@@ -64,7 +100,15 @@ class CaptivePortal:
         # See the captive portal notes in docs/captive-portal.md for why we redirect not-found
         # URLs and why we redirect them to an absolute URL (rather than a path like "/").
         # `essid` is used as the target host but any name could be used, e.g. "wifi-setup".
-        config = SlimConfig(not_found_url="http://{}/".format(essid))
+        # The portal page fetches its scripts, styles and fonts in parallel, so serve several
+        # connections at once rather than making each asset wait for the previous one. And
+        # keep connections alive to avoid a new TCP handshake for every asset.
+        config = SlimConfig(
+            not_found_url="http://{}/".format(essid),
+            max_connections=self._MAX_CONNECTIONS,
+            max_requests=self._MAX_REQUESTS,
+            header_whitelist=SlimConfig._DEFAULT_HEADER_WHITELIST + ("prefer",),
+        )
 
         slim_server = SlimServer(poller, config=config)
 
@@ -72,24 +116,27 @@ class CaptivePortal:
         slim_server.add_module(WebRouteModule([
             RegisteredRoute(HttpMethod.GET, "/api/access-points", self._request_access_points),
             RegisteredRoute(HttpMethod.POST, "/api/access-point", self._request_access_point),
+            RegisteredRoute(HttpMethod.GET, "/api/access-point/<id>", self._request_attempt),
             RegisteredRoute(HttpMethod.POST, "/api/alive", self._request_alive)
         ]))
         # fmt: on
 
-        root = self._get_relative("www")
-        # fmt: off
-        slim_server.add_module(FileserverModule({
-            "html": "text/html",
-            "css": "text/css",
-            "js": "application/javascript",
-            "woff2": "font/woff2",
-            "ico": "image/x-icon",
-            "svg": "image/svg+xml"
-        }, root))
-        # fmt: on
+        slim_server.add_module(
+            FrozenFileserverModule.create(self._FROZEN_WWW, self._create_fileserver)
+        )
 
         return slim_server
 
+    # If `update-lib-www --bundle` has been used to pack the files in `www` into a single
+    # bundle, and it's been deployed, then it's used in preference to the `www` directory.
+    def _create_fileserver(self):
+        bundle = self._get_relative("www.bundle")
+        if exists(bundle):
+            return BundleFileserverModule(bundle, cache_size=self._CACHE_SIZE)
+
+        root = self._get_relative("www")
+        return FileserverModule(MIME_TYPES, root, cache_size=self._CACHE_SIZE)
+
     # Find a file, given a path relative to the directory contain this `.py` file.
     @staticmethod
     def _get_relative(filename):
@@ -105,11 +152,36 @@ class CaptivePortal:
 
         return MicroDNSSrv(resolve, poller)
 
+    # Respond from the cache, with an Age header saying how old the results are, and leave
+    # it to `_rescan` to refresh them.
     def _request_access_points(self, request):
-        # Tuples are  of the form (SSID, BSSID, channel, RSSI, authmode, hidden).
-        points = [(p[0], p[3], p[4]) for p in self._ap.scan()]
-        request.Response.ReturnOkJSON(points)
-
+        self._scan_wanted = True
+        age = self._access_points.age_sec()
+        if age is not None:
+            request.Response.SetHeader("Age", age)
+        request.Response.ReturnOkJSON(self._access_points.points())
+
+    # Scanning blocks everything, i.e. HTTP and DNS, for one to three seconds, so rather than
+    # hold up a request that's in progress, put off scanning until the server is idle. And
+    # don't disrupt a connection attempt (scanning switches the radio between channels).
+    def _rescan(self):
+        if not self._scan_wanted or self._connecting():
+            return
+        if not self._slim_server.is_idle():
+            return
+        self._scan_wanted = False
+        self._access_points.scan()
+
+    def _connecting(self):
+        if self._reconnect_attempt:
+            return True
+        return self._attempt and self._attempt.state == ConnectAttempt.CONNECTING
+
+    # Connecting takes a few seconds so it's polled by a scheduled job, leaving the event loop
+    # free to serve other requests (and DNS) meanwhile. If the client sends the header
+    # `Prefer: respond-async`, the response is `202 Accepted`, with the attempt's ID, straight
+    # away and the client can poll the `Location` URL for its progress. Otherwise the response
+    # is held back until the attempt succeeds (200) or fails (403).
     def _request_access_point(self, request):
         data = request.GetPostedURLEncodedForm()
         _logger.debug("connect request data %s", data)
@@ -120,11 +192,99 @@ class CaptivePortal:
 
         password = data.get("password", None)
 
-        result = self._connect(ssid, password)
-        if not result:
-            request.Response.ReturnForbidden()
+        if self._attempt and self._attempt.state == ConnectAttempt.CONNECTING:
+            request.Response.Return(self._CONFLICT)
+            return
+
+        # The user's choice takes precedence over any background attempt.
+        self._reconnect_attempt = None
+        self._attempt_id += 1
+        self._attempt = self._connect(ssid, password)
+
+        if "respond-async" in request.GetHeader("prefer"):
+            location = "/api/access-point/{}".format(self._attempt_id)
+            request.Response.SetHeader("Location", location)
+            self._return_attempt(request.Response, self._ACCEPTED)
+            pending = None
         else:
-            request.Response.ReturnOkJSON({"message": result})
+            pending = (request, request.Generation)
+
+        def poll():
+            return self._poll_attempt(pending)
+
+        self._schedule.every(self._CONNECT_POLL_SEC).seconds.do(poll)
+
+        return None if pending is None else SlimServer.RESPONSE_PENDING
+
+    # Returns `CancelJob` once the attempt has completed, after responding to the held-back
+    # request, if there is one.
+    def _poll_attempt(self, pending):
+        state = self._attempt.poll()
+        if state == ConnectAttempt.CONNECTING:
+            return None
+        if pending:
+            (request, generation) = pending
+            # The request object is reused if the client gives up and its connection is closed.
+            if request.Generation != generation:
+                _logger.warning("client went away before connecting completed")
+            elif state == ConnectAttempt.CONNECTED:
+                request.Response.ReturnOkJSON({"message": self._attempt.message})
+            else:
+                request.Response.ReturnForbidden()
+        return CancelJob
+
+    def _schedule_reconnect(self):
+        delay_sec = self._retry.delay_ms(self._retries) / 1000
+        self._retries += 1
+        self._schedule.every(delay_sec).seconds.do(self._start_reconnect)
+
+    # Connecting to a known network, e.g. once a router that was down has rebooted, is polled
+    # in the same way as an attempt started via `/api/access-point`. Connecting while the
+    # access point is active can disrupt it, e.g. some ports switch its channel.
+    def _start_reconnect(self):
+        if self._attempt and self._attempt.state == ConnectAttempt.CONNECTED:
+            return CancelJob  # The user has set up a network so stop retrying.
+        if self._attempt and self._attempt.state == ConnectAttempt.CONNECTING:
+            self._schedule_reconnect()
+            return CancelJob
+
+        attempt = self._reconnect()
+        self._reconnect_attempt = attempt
+
+        def poll():
+            return self._poll_reconnect(attempt)
+
+        self._schedule.every(self._CONNECT_POLL_SEC).seconds.do(poll)
+        return CancelJob
+
+    def _poll_reconnect(self, attempt):
+        if attempt is not self._reconnect_attempt:
+            # Abandoned in favor of the user's attempt.
+            self._schedule_reconnect()
+            return CancelJob
+        state = attempt.poll()
+        if state == ConnectAttempt.CONNECTING:
+            return None
+        self._reconnect_attempt = None
+        if state == ConnectAttempt.CONNECTED:
+            _logger.info("reconnected to a known network, shutting down")
+            self._loop.stop()
+        else:
+            self._schedule_reconnect()
+        return CancelJob
+
+    def _request_attempt(self, request, args):
+        if not self._attempt or args["id"] != str(self._attempt_id):
+            request.Response.Return(self._NOT_FOUND)
+            return
+        self._return_attempt(request.Response, self._OK)
+
+    def _return_attempt(self, response, code):
+        attempt = self._attempt
+        body = {"id": self._attempt_id, "ssid": attempt.ssid, "state": attempt.state}
+        if attempt.message is not None:
+            body["message"] = attempt.message
+        response.ReturnJSON(code, body)
 
     def _request_alive(self, request):
         data = request.GetPostedURLEncodedForm()
@@ -143,11 +303,15 @@ class CaptivePortal:
 
     # If a client specifies a keep-alive period of Xs then they must ping again within Xs plus a fixed "tolerance".
     _TOLERANCE = 1
+    _OK = 200
+    _ACCEPTED = 202
     _NO_CONTENT = 204
+    _NOT_FOUND = 404
+    _CONFLICT = 409
 
     def _timed_out(self):
         _logger.info("keep-alive timeout expired.")
-        self._alive = False
+        self._loop.stop()
         self._timeout_job = None
         return CancelJob  # Tell scheduler that we want one-shot behavior.
 
@@ -0,0 +1,76 @@
+import logging
+from time import ticks_ms, ticks_diff
+
+
+_logger = logging.getLogger("connect_attempt")
+
+
+# Joining a network takes a few seconds so, rather than block until it's done, `start` begins
+# the attempt and then `poll` is called, e.g. from a scheduled job, until `state` is no longer
+# `CONNECTING`. On success, `on_connected` is called and what it returns is kept as `message`.
+# If `bssid` is given, only that access point is joined (rather than whichever access point,
+# with the given SSID, the WiFi stack finds first).
+class ConnectAttempt:
+    CONNECTING = "connecting"
+    CONNECTED = "connected"
+    FAILED = "failed"
+
+    # My ESP32 takes about 2 seconds to join, so 8s is a long timeout.
+    TIMEOUT_MS = 8000
+
+    def __init__(
+        self,
+        sta,
+        ssid,
+        password,
+        hostname,
+        on_connected=None,
+        bssid=None,
+        timeout_ms=TIMEOUT_MS,
+    ):
+        self._sta = sta
+        self.ssid = ssid
+        self._password = password
+        self._hostname = hostname
+        self._on_connected = on_connected
+        self._bssid = bssid
+        self._timeout_ms = timeout_ms
+        self._start = None
+        self.state = None
+        self.message = None
+
+    def start(self):
+        _logger.info("attempting to connect to %s", self.ssid)
+
+        # Now use the ESSID, i.e. the temporary access point name, as the device
+        # hostname when making the DHCP request. MicroPython will then also
+        # advertise this name using mDNS and you should be able to access the
+        # device as <hostname>.local.
+        self._sta.config(dhcp_hostname=self._hostname)
+
+        # Password may be none if the network is open.
+        if self._bssid:
+            self._sta.connect(self.ssid, self._password, bssid=self._bssid)
+        else:
+            self._sta.connect(self.ssid, self._password)
+        self._start = ticks_ms()
+        self.state = self.CONNECTING
+
+    # I had hoped I could use wlan.status() to e.g. report if the password was wrong.
+    # But with MicroPython 1.12 (and my Ubiquiti UniFi AP AC-PRO) wlan.status() doesn't prove very useful.
+    # See https://forum.micropython.org/viewtopic.php?f=18&t=7942
+    def poll(self):
+        if self.state != self.CONNECTING:
+            return self.state
+        if self._sta.isconnected():
+            _logger.info(
+                "connected to %s with address %s", self.ssid, self._sta.ifconfig()[0]
+            )
+            if self._on_connected:
+                self.message = self._on_connected()
+            self.state = self.CONNECTED
+        elif ticks_diff(ticks_ms(), self._start) > self._timeout_ms:
+            self._sta.disconnect()
+            _logger.error("failed to connect to %s", self.ssid)
+            self.state = self.FAILED
+        return self.state
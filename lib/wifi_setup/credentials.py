@@ -1,50 +1,155 @@
 import errno
 import btree
+import json
 import logging
+from binascii import hexlify, unhexlify
 
 _logger = logging.getLogger("credentials")
 
 
 # Credentials uses `btree` to store and retrieve data. In retrospect it would
 # probably have been at least as easy to just write and read it as JSON.
+# Each known network is stored under its own key, as a JSON object with its password, when it
+# was last connected to and the profile (see `put_profile`) from that connection. "When" is a
+# counter, rather than a time, as the clock isn't necessarily set on startup.
 class Credentials:
+    # The keys used when only one network was stored.
     _SSID = b"ssid"
     _PASSWORD = b"password"
+
+    _NETWORK_PREFIX = b"network:"
+    _LAST = b"last"
     _CREDENTIALS = "credentials"
+    # Once there are this many networks, adding one drops the least recently used.
+    _MAX_NETWORKS = 8
 
     def __init__(self, filename=_CREDENTIALS):
         self._filename = filename
 
+    # Returns the (SSID, password) of the network that was most recently connected to.
     def get(self):
-        def action(db):
-            ssid = db.get(self._SSID)
-            password = db.get(self._PASSWORD)
+        networks = self.networks()
+        return networks[0][:2] if networks else (None, None)
 
-            return (ssid, password) if ssid else (None, None)
+    # Returns a list of (SSID, password, last) tuples, most recently connected to first.
+    def networks(self):
+        def action(db):
+            networks = [(ssid, n["password"], n["last"]) for ssid, n in self._items(db)]
+            networks.sort(key=lambda n: n[2], reverse=True)
+            return networks
 
         return self._db_action(action)
 
+    # Add a network, or replace the password of a known one, and mark it as most recently
+    # connected to.
     def put(self, ssid, password):
+        if isinstance(password, bytes):
+            password = password.decode()
+
         def action(db):
-            db[self._SSID] = ssid
-            if password:
-                db[self._PASSWORD] = password
-            else:
-                self._pop(db, self._PASSWORD, None)
+            networks = list(self._items(db))
+            if len(networks) >= self._MAX_NETWORKS and not self._get(db, ssid):
+                oldest = min(networks, key=lambda n: n[1]["last"])
+                del db[self._key(oldest[0])]
+            self._put(db, ssid, {"password": password, "last": self._next_last(db)})
+
+        self._db_action(action)
+
+    # Mark a known network as most recently connected to.
+    def succeeded(self, ssid):
+        def action(db):
+            network = self._get(db, ssid)
+            if network:
+                network["last"] = self._next_last(db)
+                self._put(db, ssid, network)
+
+        self._db_action(action)
+
+    # Returns the (BSSID, channel, ifconfig) profile, recorded by `put_profile`, or None. The
+    # `ifconfig` value is an (IP, netmask, gateway, DNS) tuple of the kind that's passed to
+    # `WLAN.ifconfig`.
+    def get_profile(self, ssid):
+        def action(db):
+            network = self._get(db, ssid)
+            if not network or "bssid" not in network:
+                return None
+            bssid = unhexlify(network["bssid"])
+            return bssid, network["channel"], tuple(network["ifconfig"])
+
+        return self._db_action(action)
+
+    # Record the details of the access point, and of the DHCP lease, from a successful
+    # connection to a known network, so that the next connection can skip straight to them.
+    def put_profile(self, ssid, bssid, channel, ifconfig):
+        def action(db):
+            network = self._get(db, ssid)
+            if network:
+                network["bssid"] = hexlify(bssid).decode()
+                network["channel"] = channel
+                network["ifconfig"] = list(ifconfig)
+                self._put(db, ssid, network)
+
+        self._db_action(action)
+
+    def clear_profile(self, ssid):
+        def action(db):
+            network = self._get(db, ssid)
+            if network and "bssid" in network:
+                for key in ("bssid", "channel", "ifconfig"):
+                    del network[key]
+                self._put(db, ssid, network)
 
         self._db_action(action)
 
     def clear(self):
         def action(db):
-            self._pop(db, self._SSID, None)
-            self._pop(db, self._PASSWORD, None)
+            for key in list(db):
+                del db[key]
 
         self._db_action(action)
 
+    # Returns (SSID, network) pairs for all the known networks.
+    def _items(self, db):
+        prefix = self._NETWORK_PREFIX
+        for key in list(db):
+            if key.startswith(prefix):
+                yield key[len(prefix) :], json.loads(db[key])
+
+    def _get(self, db, ssid):
+        value = db.get(self._key(ssid))
+        return json.loads(value) if value else None
+
+    def _put(self, db, ssid, network):
+        db[self._key(ssid)] = json.dumps(network)
+
+    def _key(self, ssid):
+        if isinstance(ssid, str):
+            ssid = ssid.encode()
+        return self._NETWORK_PREFIX + ssid
+
+    def _next_last(self, db):
+        value = db.get(self._LAST)
+        last = int(value.decode()) + 1 if value else 1
+        db[self._LAST] = str(last)
+        return last
+
+    # Convert the single network stored by earlier versions.
+    def _migrate(self, db):
+        ssid = self._pop(db, self._SSID, None)
+        if ssid:
+            password = self._pop(db, self._PASSWORD, None)
+            if password:
+                password = password.decode()
+            self._put(db, ssid, {"password": password, "last": self._next_last(db)})
+        for key in (b"bssid", b"channel", b"ifconfig"):
+            self._pop(db, key, None)
+
     def _db_action(self, action):
         with self._access(self._filename) as f:
             db = btree.open(f)  # Btree doesn't support `with`.
             try:
+                if self._SSID in db:
+                    self._migrate(db)
                 return action(db)
             finally:
                 # Note that closing the DB does a flush.
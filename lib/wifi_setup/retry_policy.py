@@ -0,0 +1,30 @@
+import random
+
+
+# Controls how `WiFiSetup.connect_or_setup` retries the known networks before falling back to
+# the captive portal, e.g. so that a router reboot doesn't leave every device in setup mode.
+# The delay before each retry doubles, from `base_ms` up to `max_delay_ms`, and retrying stops
+# once `max_wait_ms` has passed since the first failure. Each delay is randomly between half
+# and all of its nominal value, so devices that lost the same router don't retry in lockstep.
+# If `background` is true, the known networks continue to be retried, with the same delays
+# (but no time limit), while the portal runs and the portal is shut down if one of them
+# connects.
+class RetryPolicy:
+    def __init__(
+        self,
+        base_ms=1000,
+        max_delay_ms=60 * 1000,
+        max_wait_ms=5 * 60 * 1000,
+        background=False,
+    ):
+        self.base_ms = base_ms
+        self.max_delay_ms = max_delay_ms
+        self.max_wait_ms = max_wait_ms
+        self.background = background
+
+    # Returns the delay before the given retry, where the first retry is 0.
+    def delay_ms(self, retry):
+        # Limit the shift, rather than create a huge int, for large retry counts.
+        nominal = min(self.max_delay_ms, self.base_ms << min(retry, 16))
+        half = nominal // 2
+        return half + random.randint(0, nominal - half)
@@ -3,22 +3,31 @@ import time
 import logging
 
 from wifi_setup.credentials import Credentials
+from wifi_setup.connect_attempt import ConnectAttempt
 
 
 _logger = logging.getLogger("wifi_setup")
 
 
 class WiFiSetup:
-    # My ESP32 takes about 2 seconds to join, so 8s is a long timeout.
-    _CONNECT_TIMEOUT = 8000
+    _POLL_MS = 50
+    # Joining a known access point, with a static IP config, is quick so if it hasn't
+    # happened within this time then something's changed and it's time to do things in full.
+    _FAST_CONNECT_TIMEOUT = 3000
+    # Stop trying known networks once this much time has been spent connecting.
+    _CONNECT_BUDGET = 20000
 
     # The default `message` function returns the device's IP address but
     # one could provide a function that e.g. returned an MQTT topic ID.
-    def __init__(self, essid, message=None):
+    # If `retry` is a `RetryPolicy` then `connect_or_setup` retries the known networks before
+    # falling back to setup, otherwise it goes straight to setup if `connect` fails.
+    def __init__(self, essid, message=None, retry=None):
         self._essid = essid
         # You can't use a static method as a default argument
         # https://stackoverflow.com/a/21672157/245602
         self._message = message if message else self._default_message
+        self._retry = retry
+        self._known_index = 0
 
         self._credentials = Credentials()
         self._sta = network.WLAN(network.STA_IF)
@@ -27,69 +36,162 @@ class WiFiSetup:
     def has_ssid(self):
         return self._credentials.get()[0] is not None
 
+    # Try the most recently used network via `_fast_connect` and, if that fails, scan and try
+    # the known networks that are visible (see `_rank`) until one succeeds or the time budget
+    # is used up.
     def connect(self):
-        ssid, password = self._credentials.get()
+        networks = self._credentials.networks()
+        if not networks:
+            return None
+        start = time.ticks_ms()
 
-        return self._sta if ssid and self._connect(ssid, password) else None
+        (ssid, password, _) = networks[0]
+        if self._fast_connect(ssid, password):
+            return self._sta
+
+        visible = self._scan()
+        for (ssid, password, _) in self._rank(networks, visible):
+            remaining = self._CONNECT_BUDGET - time.ticks_diff(time.ticks_ms(), start)
+            if remaining <= 0:
+                _logger.info("giving up, the connect time budget has been used up")
+                break
+            timeout_ms = min(remaining, ConnectAttempt.TIMEOUT_MS)
+            if self._connect(ssid, password, timeout_ms=timeout_ms):
+                self._credentials.succeeded(ssid)
+                self._save_profile(ssid, visible.get(ssid))
+                return self._sta
+        return None
 
     def setup(self):
         from wifi_setup.captive_portal import CaptivePortal
 
+        retry = self._retry
+        if retry and retry.background and self.has_ssid():
+            reconnect = self._connect_known
+        else:
+            retry = reconnect = None
+
         # `run` will only return once WiFi is setup.
-        CaptivePortal().run(self._essid, self._connect_new)
+        CaptivePortal().run(self._essid, self._connect_new, reconnect, retry)
 
         return self._sta
 
     def connect_or_setup(self):
-        if not self.connect():
+        if not self._connect_with_retry():
             self.setup()
 
         return self._sta
 
+    def _connect_with_retry(self):
+        if self.connect():
+            return True
+        if not self._retry or not self.has_ssid():
+            return False
+
+        start = time.ticks_ms()
+        retry = 0
+        while True:
+            delay = self._retry.delay_ms(retry)
+            elapsed = time.ticks_diff(time.ticks_ms(), start)
+            if elapsed + delay > self._retry.max_wait_ms:
+                _logger.info("giving up on the known networks after %dms", elapsed)
+                return False
+            _logger.info("retrying in %dms", delay)
+            time.sleep_ms(delay)
+            if self.connect():
+                return True
+            retry += 1
+
     @staticmethod
     def clear():
         Credentials().clear()
 
+    # Starts connecting to a network chosen via the captive portal and returns the
+    # `ConnectAttempt`. If it succeeds, the credentials are saved and its `message` is set.
     def _connect_new(self, ssid, password):
-        if not self._connect(ssid, password):
-            return None
-
-        self._credentials.put(ssid, password)
-        return self._message(self._sta)
+        def on_connected():
+            self._credentials.put(ssid, password)
+            return self._message(self._sta)
+
+        attempt = ConnectAttempt(self._sta, ssid, password, self._essid, on_connected)
+        attempt.start()
+        return attempt
+
+    # Starts connecting to the next known network, in turn, for the captive portal to retry
+    # them in the background. Unlike `connect`, there's no scan as that would hold up the
+    # portal, and no fast path, as that would leave a static IP config behind if it failed.
+    def _connect_known(self):
+        networks = self._credentials.networks()
+        (ssid, password, _) = networks[self._known_index % len(networks)]
+        self._known_index += 1
+
+        def on_connected():
+            self._credentials.succeeded(ssid)
+            return self._message(self._sta)
+
+        attempt = ConnectAttempt(self._sta, ssid, password, self._essid, on_connected)
+        attempt.start()
+        return attempt
 
     @staticmethod
     def _default_message(sta):
         return sta.ifconfig()[0]
 
-    def _connect(self, ssid, password):
-        _logger.info("attempting to connect to %s", ssid)
-
-        # Now use the ESSID, i.e. the temporary access point name, as the device
-        # hostname when making the DHCP request. MicroPython will then also
-        # advertise this name using mDNS and you should be able to access the
-        # device as <hostname>.local.
-        self._sta.config(dhcp_hostname=self._essid)
-
-        # Password may be none if the network is open.
-        self._sta.connect(ssid, password)
-
-        if not self._sync_wlan_connect(self._sta):
-            _logger.error("failed to connect to %s", ssid)
+    # Used at startup, when there's nothing else to do, so just poll until the attempt's done.
+    def _connect(self, ssid, password, **kwargs):
+        attempt = ConnectAttempt(self._sta, ssid, password, self._essid, **kwargs)
+        attempt.start()
+        while attempt.poll() == ConnectAttempt.CONNECTING:
+            time.sleep_ms(self._POLL_MS)
+        return attempt.state == ConnectAttempt.CONNECTED
+
+    # Rather than scan for the network and then wait for DHCP, go straight to the access
+    # point, and reuse the IP config, from the last successful connection. This relies on the
+    # router giving the device the same address each time, e.g. due to a DHCP reservation.
+    def _fast_connect(self, ssid, password):
+        profile = self._credentials.get_profile(ssid)
+        if not profile:
             return False
-
-        _logger.info("connected to %s with address %s", ssid, self._sta.ifconfig()[0])
-        return True
-
-    # I had hoped I could use wlan.status() to e.g. report if the password was wrong.
-    # But with MicroPython 1.12 (and my Ubiquiti UniFi AP AC-PRO) wlan.status() doesn't prove very useful.
-    # See https://forum.micropython.org/viewtopic.php?f=18&t=7942
+        (bssid, channel, ifconfig) = profile
+
+        self._sta.ifconfig(ifconfig)  # Setting a static IP config disables DHCP.
+        try:
+            self._sta.config(channel=channel)
+        except (ValueError, OSError):
+            pass  # Not every port supports setting the channel in station mode.
+        timeout_ms = self._FAST_CONNECT_TIMEOUT
+        if self._connect(ssid, password, bssid=bssid, timeout_ms=timeout_ms):
+            return True
+
+        _logger.info("fast connect failed, falling back to a full connect")
+        self._credentials.clear_profile(ssid)
+        self._sta.ifconfig("dhcp")
+        return False
+
+    # Returns a dict that maps the SSIDs of visible networks to the scan result, i.e. an
+    # (SSID, BSSID, channel, RSSI, authmode, hidden) tuple, for their strongest access point.
+    def _scan(self):
+        visible = {}
+        for p in self._sta.scan():
+            strongest = visible.get(p[0])
+            if not strongest or p[3] > strongest[3]:
+                visible[p[0]] = p
+        return visible
+
+    # Orders the known networks, that are visible, by signal strength and then, for equal
+    # strengths, by how recently they were used. If none are visible, the most recently used
+    # is tried anyway as hidden networks don't appear in scans under their SSID.
     @staticmethod
-    def _sync_wlan_connect(wlan, timeout=_CONNECT_TIMEOUT):
-        start = time.ticks_ms()
-        while True:
-            if wlan.isconnected():
-                return True
-            diff = time.ticks_diff(time.ticks_ms(), start)
-            if diff > timeout:
-                wlan.disconnect()
-                return False
+    def _rank(networks, visible):
+        ranked = [n for n in networks if n[0] in visible]
+        if not ranked:
+            return networks[:1]
+        ranked.sort(key=lambda n: (visible[n[0]][3], n[2]), reverse=True)
+        return ranked
+
+    # The access point's BSSID and channel aren't available from the connected `WLAN` so
+    # they come from the scan.
+    def _save_profile(self, ssid, scanned):
+        if scanned:
+            ifconfig = self._sta.ifconfig()
+            self._credentials.put_profile(ssid, scanned[1], scanned[2], ifconfig)